@@ -0,0 +1,83 @@
+import time
+import hashlib
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def context_hash(context: str):
+    return hashlib.sha256(context.encode("utf-8")).hexdigest()
+
+class SemanticAnswerCache:
+    # Answers are grouped by the hash of the retrieved context; within a group a
+    # stored answer is reused when the new query embedding is within
+    # `threshold` cosine similarity of the one it was generated for. Entries
+    # expire after ttl_seconds, the least recently used are evicted beyond
+    # max_size, and everything is dropped when the index version changes.
+    def __init__(self, threshold: float = 0.95, max_size: int = 512, ttl_seconds: float = 3600):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._index_version = None
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _check_version(self, index_version):
+        if index_version != self._index_version:
+            if self._entries:
+                logger.info(f"Index version changed to {index_version}, dropping {len(self._entries)} cached answers")
+            self._entries.clear()
+            self._index_version = index_version
+
+    def lookup(self, query_embedding, context: str, index_version):
+        query = self._normalize(query_embedding)
+        group = context_hash(context)
+        now = time.time()
+        with self._lock:
+            self._check_version(index_version)
+            best_key, best_score = None, self.threshold
+            for key, (entry_group, embedding, answer, stored_at) in list(self._entries.items()):
+                if now - stored_at > self.ttl_seconds:
+                    del self._entries[key]
+                    continue
+                if entry_group != group:
+                    continue
+                score = float(np.dot(query, embedding))
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self._hits += 1
+            return self._entries[best_key][2]
+
+    def store(self, query_embedding, context: str, index_version, answer: str):
+        embedding = self._normalize(query_embedding)
+        group = context_hash(context)
+        key = (group, hashlib.sha256(embedding.tobytes()).hexdigest())
+        with self._lock:
+            self._check_version(index_version)
+            self._entries[key] = (group, embedding, answer, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses, "size": len(self._entries)}
@@ -1,30 +1,42 @@
 import streamlit as st
 import os
-import json
 import logging
-import json
 import uuid
+import time
 import requests
 from io import BytesIO
 from PIL import Image
-from llm_interface import get_text_response, get_image_response
-from pdf_processor import process_new_pdfs
-from vector_store import query_vector_store, get_vector_store
+from llm_interface import stream_text_response, stream_image_response, prefetch_conversation_summary, TEXT_EMPTY_RESPONSE, TEXT_ERROR_RESPONSE
+from ingestion_worker import IngestionWorker
+from vector_store import query_vector_store, get_vector_store, embed_query
+from index_versions import current_version_dir
+from answer_cache import SemanticAnswerCache
 from dotenv import load_dotenv
-from google.cloud import storage
+from gcs_client import get_bucket
 from streamlit_session_browser_storage import SessionStorage
-from audio_processor import transcribe_audio, text_to_speech
+from audio_processor import transcribe_audio
+from voice_pipeline import SentenceSplitter, SpeechSynthesizer, VoicePlayback
+from chat_history import get_chat_history_store
+from conversation_counter import get_conversation_counter
+from turn_stages import TurnStages
+from image_processor import prepare_image, upload_prepared_image
+from metrics import span, timed, observe, new_trace_id, start_metrics_server
 
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-DATA_PATH = "pdf/new/"
-BUCKET_NAME = "aiysha-convos"
-CONVERSATION_TRACK_BLOB = "history/count/conversations.txt"
+start_metrics_server()
 
-bucket = storage.Client().bucket(BUCKET_NAME)
+# "thread": every app instance polls for new PDFs, and the GCS ingestion lease
+# lets one of them ingest at a time. "external": a separate
+# `python ingestion_worker.py` process does the ingestion.
+INGESTION_MODE = os.getenv("INGESTION_MODE", "thread")
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
 
 st.set_page_config(
     page_title="Aiysha from yShade.AI",
@@ -45,19 +57,15 @@ def get_chat_history_id():
         st.session_state.chat_history_id = chat_history_id
     return st.session_state.chat_history_id
 
-def save_chat_history(messages):
-    chat_history_id = get_chat_history_id()
-    blob = bucket.blob(f"history/chats/{chat_history_id}.json")
-    blob.upload_from_string(json.dumps(messages))
+@timed("gcs.reset_history")
+def clear_chat_history():
+    st.session_state.messages = []
+    get_chat_history_store().reset(get_chat_history_id())
 
+@timed("gcs.load_history")
 def load_chat_history():
-    chat_history_id = get_chat_history_id()
-    blob = bucket.blob(f"history/chats/{chat_history_id}.json")
-    if blob.exists():
-        return json.loads(blob.download_as_string())
-    return []
+    return get_chat_history_store().load(get_chat_history_id())
 
-@st.cache_resource
 def get_vector_store_wrapper():
     try:
         return get_vector_store()
@@ -65,15 +73,22 @@ def get_vector_store_wrapper():
         logger.error(f"Failed to initialize vector store: {str(e)}")
         return None
 
-def check_and_process_new_pdfs():
-    blobs = list(bucket.list_blobs(prefix=DATA_PATH))
-    if not blobs:
-        return False, ""
-    processed_count = process_new_pdfs()
-    if processed_count > 0:
-        return True, f"I have {processed_count} beauty bot(s) busy blending and perfecting! Just like a good contour, it takes a little time to get it right."
-    else:
-        return False, ""
+@st.cache_resource
+def get_answer_cache():
+    return SemanticAnswerCache(threshold=ANSWER_CACHE_THRESHOLD, max_size=ANSWER_CACHE_SIZE, ttl_seconds=ANSWER_CACHE_TTL)
+
+@st.cache_resource
+def get_ingestion_worker():
+    worker = IngestionWorker()
+    if INGESTION_MODE == "thread":
+        worker.start()
+    return worker
+
+def get_ingestion_status():
+    status = get_ingestion_worker().status()
+    if status.running:
+        return True, f"I have {status.pending_files} beauty bot(s) busy blending and perfecting! Just like a good contour, it takes a little time to get it right."
+    return False, ""
 
 @st.cache_data
 def load_sidebar_logo(image_path, size=(150, 150)):
@@ -86,38 +101,48 @@ def load_image_from_url(url: str) -> Image:
     image = Image.open(BytesIO(response.content))
     return image
 
-def update_conversation_count():
-    blob = bucket.blob(CONVERSATION_TRACK_BLOB)
-
-    if not blob.exists():
-        blob.upload_from_string("queries: 0\nresponses: 0")
-
+def render_response_stream(response_stream, placeholder, on_delta=None):
+    # Raises if the stream fails part way; the partial text stays on screen
+    # without the cursor, and the caller shows the error
+    response = ""
     try:
-        content = blob.download_as_text()
-        lines = content.split('\n')
-
-        queries = int(lines[0].split(': ')[1])
-        responses = int(lines[1].split(': ')[1])
-
-        queries += 1
-        responses += 1
+        with st.spinner(""):
+            for delta in response_stream:
+                response += delta
+                placeholder.markdown(response + "▌")
+                if on_delta:
+                    on_delta(delta)
+                break
+        for delta in response_stream:
+            response += delta
+            placeholder.markdown(response + "▌")
+            if on_delta:
+                on_delta(delta)
+    finally:
+        placeholder.markdown(response)
+    return response
+
+def record_assistant_message(stages, chat_history_id, message):
+    message["audio"] = stages.result_or("response_audio_upload")
+    get_chat_history_store().append(chat_history_id, message)
+
+def upload_response_audio(stages):
+    combined_audio = stages.result_or("response_audio")
+    return upload_audio_to_gcs(combined_audio) if combined_audio is not None else None
 
-        new_content = f"queries: {queries}\nresponses: {responses}"
-        blob.upload_from_string(new_content)
-    except Exception as e:
-        logger.error(f"Error updating conversation count: {e}")
+def update_conversation_count():
+    get_conversation_counter().increment(queries=1, responses=1)
 
 def upload_image_to_gcs(image_file):
-    file_name = f"uploads/images/{uuid.uuid4()}.{image_file.name.split('.')[-1]}"
-    blob = bucket.blob(file_name)
-    blob.upload_from_file(image_file)
-    gcs_uri = f"gs://{bucket.name}/{file_name}"
-    public_url = blob.public_url
-    return gcs_uri, public_url
+    with span("image.prepare"):
+        prepared = prepare_image(image_file.getvalue())
+    with span("gcs.upload_image"):
+        return upload_prepared_image(get_bucket(), prepared)
 
+@timed("gcs.upload_audio")
 def upload_audio_to_gcs(audio_bytes):
     file_name = f"uploads/audio/{uuid.uuid4()}.wav"
-    blob = bucket.blob(file_name)
+    blob = get_bucket().blob(file_name)
     blob.upload_from_string(audio_bytes, content_type='audio/wav')
     return blob.public_url
 
@@ -165,11 +190,12 @@ BOT_AVATAR = Image.open("images/aiysha_avatar.png")
 
 if "messages" not in st.session_state:
     st.session_state.messages = load_chat_history()
+    # A long restored history gets its summary folded before the first question needs it
+    TurnStages().start("summary_fold", prefetch_conversation_summary, list(st.session_state.messages))
 
 with st.sidebar:
     if st.button("Delete Chat History"):
-        st.session_state.messages = []
-        save_chat_history([])
+        clear_chat_history()
 
 for message in st.session_state.messages:
     avatar = USER_AVATAR if message["role"] == "user" else BOT_AVATAR
@@ -189,11 +215,21 @@ with c1:
 with c2:
     send_button = st.button("", icon=":material/send:", disabled=not prompt and not audio_input)
 
+def record_user_message(stages, chat_history_id, message, is_audio_turn):
+    # Runs after the uploads settle so the stored message carries their URLs
+    if is_audio_turn:
+        message["audio"] = stages.result_or("audio_upload")
+    else:
+        message["image"] = stages.result_or("image_upload", (None, None))[1]
+    get_chat_history_store().append(chat_history_id, message)
+
 if send_button or audio_input:
+    turn_started = time.perf_counter()
+    trace_id = new_trace_id()
     user_input = prompt
-    public_image_url = None
+    audio_bytes = None
     gcs_image_uri = None
-    user_audio_url = None 
+    stages = TurnStages()
 
     if audio_input:
         audio_bytes = audio_input.read()
@@ -201,78 +237,112 @@ if send_button or audio_input:
             transcription = transcribe_audio(audio_bytes)
             if transcription:
                 user_input = transcription
-                user_audio_url = upload_audio_to_gcs(audio_bytes)
+                stages.start("audio_upload", upload_audio_to_gcs, audio_bytes)
         except Exception as e:
             logger.error(f"Error in ASR request: {str(e)}")
             st.error("Oops, it looks like I didn't quite catch that! Can you please try speaking again, or maybe enunciate a bit more for me? I want to make sure I get your beauty question just right!")
             st.stop()
 
+    # Uploads, history writes and retrieval overlap; only retrieval (and the
+    # image upload, for vision turns) is waited on before the LLM call.
     if image_file:
-        gcs_image_uri, public_image_url = upload_image_to_gcs(image_file)
+        stages.start("image_upload", upload_image_to_gcs, image_file)
 
-    if audio_input:
-        st.session_state.messages.append({
-            "role": "user",
-            "content": user_input,
-            "audio": user_audio_url if user_audio_url else None,
-            "image": None
-        })
-    else:
-        st.session_state.messages.append({
-            "role": "user",
-            "content": user_input,
-            "audio": None,
-            "image": public_image_url if public_image_url else None
-        })
-        
-    save_chat_history(st.session_state.messages)
+    vector_store = get_vector_store_wrapper()
+    if vector_store is not None:
+        stages.start("retrieval", query_vector_store, user_input, vector_store)
+
+    chat_history_id = get_chat_history_id()
+    user_message = {"role": "user", "content": user_input, "audio": None, "image": None}
+    st.session_state.messages.append(user_message)
+    stages.start("user_history", record_user_message, stages, chat_history_id, user_message, bool(audio_input), after=("audio_upload", "image_upload"))
     
     with st.chat_message("user", avatar=USER_AVATAR):
         if audio_input:
-            st.audio(data=user_audio_url, format="audio/wav", start_time=0) 
+            st.audio(data=audio_bytes, format="audio/wav", start_time=0) 
         else:
             st.markdown(user_input)
-            if public_image_url:
-                st.image(public_image_url, width=200)
+            if image_file:
+                st.image(image_file.getvalue(), width=200)
 
     with st.chat_message("assistant", avatar=BOT_AVATAR):
-        with st.spinner("Thinking..."):
-            try:
-                processing_status, message = check_and_process_new_pdfs()
-                if processing_status:
-                    st.info(f"Hold on. {message}")
-            except Exception as e:
-                logger.error(f"PDF processing error: {str(e)}", exc_info=True)
-                st.error("Ah, it looks like I'm having a bit of a beauty brain freeze! Don't worry, I'll get my thoughts together in a minute. Can you please try again, and I'll do my best to get back to you with some fabulous advice?")
+        processing_status, message = get_ingestion_status()
+        if processing_status:
+            st.info(f"Hold on. {message}")
 
         message_placeholder = st.empty()
-        vector_store = get_vector_store_wrapper()
         if vector_store is not None:
             try:
-                context = query_vector_store(user_input, vector_store)
-                with st.spinner(""):
+                context = stages.result("retrieval")
+                if image_file:
+                    gcs_image_uri, _ = stages.result("image_upload")
+                # Only first turns without an image are answered from the shared cache,
+                # so no answer depends on another user's conversation or photo.
+                use_answer_cache = ANSWER_CACHE_ENABLED and not gcs_image_uri and len(st.session_state.messages) == 1
+                response = None
+                voice = None
+                if audio_input:
+                    # Sentences go to TTS as they stream in and play back in order,
+                    # so the first clip starts long before the answer is complete.
+                    audio_placeholder = st.empty()
+                    splitter = SentenceSplitter()
+                    synthesizer = SpeechSynthesizer()
+                    voice = VoicePlayback(synthesizer, lambda clip: audio_placeholder.audio(data=clip.data, format="audio/wav", autoplay=True, start_time=0))
+
+                def speak(delta):
+                    if voice is not None:
+                        for sentence in splitter.feed(delta):
+                            synthesizer.submit(sentence)
+                        voice.poll()
+
+                if use_answer_cache:
+                    # The published version directory changes with every publish,
+                    # including those made by a separate ingestion worker process
+                    index_version = current_version_dir()
+                    query_embedding = embed_query(user_input)
+                    response = get_answer_cache().lookup(query_embedding, context, index_version)
+                if response is not None:
+                    message_placeholder.markdown(response)
+                    speak(response)
+                else:
                     if gcs_image_uri:
-                        response = get_image_response(user_input, gcs_image_uri, context, st.session_state.messages)
+                        response_stream = stream_image_response(user_input, gcs_image_uri, context, st.session_state.messages)
                     else:
-                        response = get_text_response(user_input, context, st.session_state.messages)
+                        response_stream = stream_text_response(user_input, context, st.session_state.messages)
+                    # Returns only once the stream has completed; a stream that
+                    # fails part way raises, so a truncated answer is never cached
+                    response = render_response_stream(response_stream, message_placeholder, on_delta=speak)
+                    if use_answer_cache and response not in (TEXT_EMPTY_RESPONSE, TEXT_ERROR_RESPONSE):
+                        get_answer_cache().store(query_embedding, context, index_version, response)
                 
-                if audio_input:
-                    try:
-                        audio_response_url = text_to_speech(response)
-                    except Exception as e:
-                        logger.error(f"Error in TTS request: {str(e)}")
+                assistant_message = {"role": "assistant", "content": response, "audio": None, "image": None}
+                if voice is not None:
+                    for sentence in splitter.flush():
+                        synthesizer.submit(sentence)
+                    synthesizer.close()
+                    # Combined and uploaded as soon as the last clip is synthesized,
+                    # while playback is still running
+                    stages.start("response_audio", synthesizer.combined_audio)
+                    stages.start("response_audio_upload", upload_response_audio, stages, after=("response_audio",))
+                # The answer is recorded before playback blocks the script thread, so
+                # a rerun triggered by the user meanwhile does not lose it
+                st.session_state.messages.append(assistant_message)
+                stages.start("assistant_history", record_assistant_message, stages, chat_history_id, assistant_message, after=("user_history", "response_audio_upload"))
+                stages.start("summary_fold", prefetch_conversation_summary, list(st.session_state.messages))
+                update_conversation_count()
+                turn_seconds = time.perf_counter() - turn_started
+                observe("turn", turn_seconds)
+                logger.info(f"[{trace_id}] Turn answered in {turn_seconds:.2f}s")
+                if voice is not None:
+                    voice.drain()
+                    combined_audio = stages.result_or("response_audio")
+                    if combined_audio is None:
+                        logger.error("Error in TTS request: no audio was synthesized")
                         st.error("Oh no, it looks like I've lost my voice! Don't worry, I'll try to get my vocal cords warmed up again. Can you please try once more, and I'll do my best to give you a beautiful response?")
                         st.stop()
-                    st.session_state.messages.append({"role": "assistant", "content": response, "audio": audio_response_url, "image": None}) 
-                    save_chat_history(st.session_state.messages)
-                    st.audio(data=audio_response_url, format="audio/wav", autoplay=True, start_time=0) 
-                else:
-                    message_placeholder.markdown(response)
-                    st.session_state.messages.append({"role": "assistant", "content": response, "audio": None, "image": None})
-                    save_chat_history(st.session_state.messages)
-                update_conversation_count()
+                    audio_placeholder.audio(data=combined_audio, format="audio/wav", start_time=0)
             except Exception as e:
-                logger.error(f"Error during query or response generation: {str(e)}", exc_info=True)
+                logger.error(f"[{trace_id}] Error during query or response generation: {str(e)}", exc_info=True)
                 st.error("Hmm, it looks like something's gone awry in our beauty conversation! Don't worry, I'll get my makeup bag in order and try again. Can you please give me another chance to help you with your question?")
         else:
             logger.error("Unable to initialize the vector store. Please try again later.")
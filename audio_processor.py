@@ -3,6 +3,8 @@ import logging
 import os
 from google.cloud import storage
 from dotenv import load_dotenv
+from http_client import get_http_client
+from metrics import timed
 
 load_dotenv()
 
@@ -12,10 +14,11 @@ logger = logging.getLogger(__name__)
 ASR_ENDPOINT = os.getenv("ASR_ENDPOINT")
 TTS_ENDPOINT = os.getenv("TTS_ENDPOINT")
 
+@timed("asr")
 def transcribe_audio(audio_file):
     try:
         files = {'file': ('audio.wav', audio_file, 'audio/wav')}
-        response = requests.post(ASR_ENDPOINT, files=files)
+        response = get_http_client().post(ASR_ENDPOINT, files=files, idempotent=True, hedge=True)
         response.raise_for_status()
         result = response.json()
         return result['text']
@@ -23,10 +26,11 @@ def transcribe_audio(audio_file):
         logger.error(f"Error in ASR request: {str(e)}")
         return None
 
+@timed("tts")
 def text_to_speech(text):
     try:
         payload = {"text": text}
-        response = requests.post(TTS_ENDPOINT, json=payload)
+        response = get_http_client().post(TTS_ENDPOINT, json=payload, idempotent=True, hedge=True)
         response.raise_for_status()
         result = response.json()
         return result['audio_url']
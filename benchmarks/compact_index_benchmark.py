@@ -0,0 +1,85 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+from compact_index import CompactIndex, build_compact_index, iter_collection_embeddings, normalize
+from vector_store import get_vector_store, embed_query
+from benchmarks.retrieval_benchmark import DEFAULT_QUERIES, percentile
+
+# Recall, latency and size of compact (int8 / binary, optionally truncated)
+# indexes against Chroma's HNSW search over the serving index. Ground truth is
+# an exact float32 scan. Besides the default queries, a sample of stored
+# chunks is used as queries so recall is measured on realistic vectors.
+#
+#   python -m benchmarks.compact_index_benchmark --dims 1024 512 256 --sample 200
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def exact_top_k(vectors, ids, query, k):
+    scores = vectors @ normalize(np.asarray(query, dtype=np.float32))
+    return [ids[i] for i in np.argsort(-scores)[:k]]
+
+def measure(search, queries, truth, k):
+    timings = []
+    recalls = []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        found = search(query)
+        timings.append(time.perf_counter() - start)
+        recalls.append(len(set(found[:k]) & set(expected)) / len(expected))
+    return float(np.mean(recalls)), timings
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark compact quantized indexes against Chroma.")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--candidates", type=int, default=50, help="Candidates rescored with float vectors")
+    parser.add_argument("--dims", type=int, nargs="+", default=[0], help="Truncated dimensions to try (0 for all)")
+    parser.add_argument("--sample", type=int, default=100, help="Stored chunks to use as extra queries")
+    args = parser.parse_args()
+
+    db = get_vector_store()
+    ids = []
+    blocks = []
+    for batch_ids, vectors in iter_collection_embeddings(db):
+        ids.extend(batch_ids)
+        blocks.append(normalize(vectors))
+    vectors = np.concatenate(blocks)
+    rng = np.random.default_rng(0)
+    queries = [embed_query(query) for query in DEFAULT_QUERIES]
+    queries += [vectors[i].tolist() for i in rng.choice(len(ids), size=min(args.sample, len(ids)), replace=False)]
+    truth = [exact_top_k(vectors, ids, query, args.k) for query in queries]
+
+    print(f"{len(ids)} vectors x {vectors.shape[1]} dims; float32 vectors alone are {vectors.nbytes / 2**20:.1f} MiB, "
+          f"Chroma directory is {directory_size(db._persist_directory) / 2**20:.1f} MiB")
+    print(f"{'index':>22} {'recall@k':>9} {'p50 (ms)':>9} {'p99 (ms)':>9} {'codes (MiB)':>12} {'with rerank (MiB)':>18}")
+
+    def chroma_search(query):
+        results = db.similarity_search_by_vector_with_relevance_scores(query, k=args.k)
+        return [doc.metadata.get("id") for doc, score in results]
+
+    recall, timings = measure(chroma_search, queries, truth, args.k)
+    print(f"{'chroma hnsw':>22} {recall:>9.3f} {percentile(timings, 0.5) * 1000:>9.2f} {percentile(timings, 0.99) * 1000:>9.2f} {'-':>12} {'-':>18}")
+
+    work_dir = tempfile.mkdtemp(prefix="compact-bench-")
+    try:
+        for mode in ("int8", "binary"):
+            for dims in args.dims:
+                index_dir = build_compact_index(db, os.path.join(work_dir, f"{mode}-{dims}"), mode=mode, dims=dims or None)
+                index = CompactIndex(index_dir)
+                for rerank in (False, True):
+                    def compact_search(query):
+                        results = index.search(query, k=args.k, candidates=args.candidates if rerank else args.k, rerank=rerank)
+                        return [doc_id for doc_id, score in results]
+
+                    recall, timings = measure(compact_search, queries, truth, args.k)
+                    name = f"{mode}/{index.dims}{' +rerank' if rerank else ''}"
+                    print(f"{name:>22} {recall:>9.3f} {percentile(timings, 0.5) * 1000:>9.2f} {percentile(timings, 0.99) * 1000:>9.2f} "
+                          f"{index.codes.nbytes / 2**20:>12.2f} {index.nbytes() / 2**20:>18.2f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import time
+import tempfile
+import argparse
+import statistics
+from langchain_chroma import Chroma
+from langchain_community.embeddings import FakeEmbeddings
+from vector_store import find_existing_hashes
+
+# Compares the old full-ID scan with the targeted ID/hash lookup used by
+# add_to_chroma for a fixed-size ingestion batch against collections of
+# growing size.
+#
+#   python -m benchmarks.dedupe_benchmark --sizes 1000 10000 50000
+
+def full_scan(db, ids):
+    existing_ids = set(db.get(include=[])["ids"])
+    return existing_ids.intersection(ids)
+
+def time_call(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+def grow_collection(db, start, stop, batch_size=5000):
+    for i in range(start, stop, batch_size):
+        ids = [f"pdf/new/bench.pdf:{n // 10}:{n % 10}" for n in range(i, min(i + batch_size, stop))]
+        db.add_texts([f"chunk {n}" for n in range(i, min(i + batch_size, stop))], ids=ids)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chunk dedupe against collection size.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--candidates", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as persist_dir:
+        db = Chroma(persist_directory=persist_dir, embedding_function=FakeEmbeddings(size=32))
+        # half of the candidates already exist, half are new
+        print(f"{'collection':>12} {'full scan (ms)':>16} {'targeted (ms)':>15}")
+        current = 0
+        for size in sorted(args.sizes):
+            grow_collection(db, current, size)
+            current = size
+            candidates = [f"pdf/new/bench.pdf:{n // 10}:{n % 10}" for n in range(size - args.candidates // 2, size + args.candidates // 2)]
+            assert full_scan(db, candidates) == set(find_existing_hashes(db, candidates))
+            scan = time_call(lambda: full_scan(db, candidates), args.repeats)
+            targeted = time_call(lambda: find_existing_hashes(db, candidates), args.repeats)
+            print(f"{size:>12} {scan * 1000:>16.2f} {targeted * 1000:>15.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import time
+import argparse
+import threading
+from embedding_batcher import EmbeddingBatcher
+from vector_store import get_embedding_function
+from benchmarks.retrieval_benchmark import DEFAULT_QUERIES, percentile
+
+# Query embedding throughput and latency under concurrent callers, one
+# embed_query call per request vs. the shared EmbeddingBatcher. Every request
+# is a distinct text so no cache is involved.
+#
+#   python -m benchmarks.embedding_batch_benchmark --concurrency 1 4 16 32 --windows 2 5 10
+
+def run(embed, concurrency, requests_per_thread):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        timings = []
+        for i in range(requests_per_thread):
+            text = f"{DEFAULT_QUERIES[i % len(DEFAULT_QUERIES)]} #{worker_id}-{i}"
+            start = time.perf_counter()
+            embed(text)
+            timings.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(timings)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return len(latencies) / elapsed, latencies
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched vs. per-request query embedding.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=20, help="Requests per caller thread")
+    parser.add_argument("--windows", type=float, nargs="+", default=[5.0], help="Batch windows to try, in ms")
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    embedding_function = get_embedding_function()
+    embedding_function.embed_query("warm up")
+
+    print(f"{'mode':>16} {'callers':>8} {'qps':>8} {'p50 (ms)':>9} {'p99 (ms)':>9} {'batch':>6} {'queue (ms)':>11}")
+    for concurrency in args.concurrency:
+        qps, latencies = run(embedding_function.embed_query, concurrency, args.requests)
+        print(f"{'per-request':>16} {concurrency:>8} {qps:>8.1f} {percentile(latencies, 0.5) * 1000:>9.1f} {percentile(latencies, 0.99) * 1000:>9.1f} {1:>6.1f} {0:>11.1f}")
+        for window_ms in args.windows:
+            batcher = EmbeddingBatcher(embedding_function.embed_documents, window_seconds=window_ms / 1000, max_batch_size=args.max_batch_size)
+            qps, latencies = run(batcher.embed, concurrency, args.requests)
+            stats = batcher.stats()
+            print(f"{f'batched {window_ms:g}ms':>16} {concurrency:>8} {qps:>8.1f} {percentile(latencies, 0.5) * 1000:>9.1f} {percentile(latencies, 0.99) * 1000:>9.1f} "
+                  f"{stats['mean_batch_size']:>6.1f} {stats['mean_queue_ms']:>11.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import openai
+from pypdf import PdfReader
+from langchain_community.embeddings import DeterministicFakeEmbedding
+import audio_processor
+from gcs_client import set_bucket
+from index_versions import set_index_root
+from llm_interface import set_openai_client, stream_text_response
+from vector_store import set_embedding_function, get_vector_store, query_vector_store
+from pdf_processor import process_new_pdfs, set_token_length_function, DATA_PATH
+from prompt_builder import estimate_tokens
+from voice_pipeline import SentenceSplitter, SpeechSynthesizer
+from chat_history import ChatHistoryStore
+from conversation_counter import ShardedCounter
+from turn_stages import TurnStages
+from benchmarks.fake_gcs import FakeBucket
+from benchmarks.fake_llm_server import start_fake_llm_server
+from benchmarks.fake_speech_server import start_fake_speech_server, silent_wav
+from benchmarks.retrieval_benchmark import DEFAULT_QUERIES, percentile
+
+# Runs ingestion, retrieval and full chat turns through the real modules with
+# GCS, MaaS and ASR/TTS replaced by local stand-ins, so it needs no network or
+# credentials. Results can be saved as a named baseline and later runs checked
+# against it; latencies may not grow and throughputs may not drop by more
+# than the tolerance.
+#
+#   python -m benchmarks.end_to_end --save-baseline
+#   python -m benchmarks.end_to_end --check
+#   python -m benchmarks.end_to_end --voice --llm-ttft 0.4 --profile voice --check
+#
+# Embeddings default to a deterministic fake of the same dimension as the
+# production model, with chunks sized by estimated tokens; --real-embeddings
+# uses FastEmbed and its tokenizer (the model must already be in the local
+# cache when offline).
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+EMBEDDING_DIMENSION = 1024
+WORDS = (
+    "foundation concealer primer powder blush bronzer highlighter mascara eyeliner lipstick gloss serum "
+    "moisturizer sunscreen cleanser toner retinol niacinamide hyaluronic oily dry combination sensitive "
+    "matte dewy satin shade undertone warm cool neutral coverage pores texture redness blend brush sponge"
+).split()
+
+def synthetic_pdf(pages: int, lines_per_page: int = 40, seed: int = 0):
+    # A minimal PDF with plain Helvetica text that pypdf can extract
+    rng = random.Random(seed)
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_refs = []
+    for _ in range(pages):
+        lines = [" ".join(rng.choice(WORDS) for _ in range(12)) + "." for _ in range(lines_per_page)]
+        text = " T* ".join(f"({line}) Tj" for line in lines)
+        stream = f"BT /F1 9 Tf 12 TL 40 760 Td {text} ET".encode("latin-1")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream.decode('latin-1')}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        page_refs.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(page_refs)}] /Count {pages} >>"
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    for offset in offsets:
+        output += f"{offset:010d} 00000 n \n".encode("latin-1")
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode("latin-1")
+    return bytes(output)
+
+def seed_pdfs(bucket, pdf_count: int, pages: int, pdf_dir: str | None = None):
+    # Returns the number of pages seeded
+    if pdf_dir:
+        total = 0
+        for name in sorted(os.listdir(pdf_dir)):
+            if name.lower().endswith(".pdf"):
+                path = os.path.join(pdf_dir, name)
+                with open(path, "rb") as f:
+                    bucket.put(f"{DATA_PATH}{name}", f.read(), "application/pdf")
+                total += len(PdfReader(path).pages)
+        return total
+    for i in range(pdf_count):
+        bucket.put(f"{DATA_PATH}bench-{i:03d}.pdf", synthetic_pdf(pages, seed=i), "application/pdf")
+    return pdf_count * pages
+
+def summarize(timings):
+    return {"p50_ms": percentile(timings, 0.5) * 1000, "p99_ms": percentile(timings, 0.99) * 1000}
+
+def bench_ingestion(bucket, args):
+    pages = seed_pdfs(bucket, args.pdfs, args.pages, args.pdf_dir)
+    start = time.perf_counter()
+    files = process_new_pdfs()
+    elapsed = time.perf_counter() - start
+    chunks = len(get_vector_store().get(include=[])["ids"])
+    return {
+        "files": files,
+        "pages": pages,
+        "chunks": chunks,
+        "seconds": elapsed,
+        "pages_per_second": pages / elapsed,
+        "chunks_per_second": chunks / elapsed,
+    }
+
+def bench_retrieval(db, queries, repeats):
+    timings = []
+    for _ in range(repeats):
+        for query in queries:
+            start = time.perf_counter()
+            query_vector_store(query, db)
+            timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+def timed(timings, name, fn, *args):
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        timings[name] = time.perf_counter() - start
+
+def run_turn(db, history, counter, chat_id, query, voice):
+    # The same stage layout as a turn in app.py, minus the Streamlit rendering
+    timings = {}
+    stages = TurnStages()
+    turn_start = time.perf_counter()
+    if voice:
+        query = timed(timings, "asr", audio_processor.transcribe_audio, silent_wav(2.0)) or query
+
+    stages.start("retrieval", timed, timings, "retrieval", query_vector_store, query, db)
+    stages.start("user_history", timed, timings, "user_history", history.append, chat_id, {"role": "user", "content": query})
+    context = stages.result("retrieval")
+
+    llm_start = time.perf_counter()
+    splitter = SentenceSplitter() if voice else None
+    synthesizer = SpeechSynthesizer() if voice else None
+    first_audio = None
+    response = ""
+    for delta in stream_text_response(query, context, []):
+        if not response:
+            timings["llm_first_token"] = time.perf_counter() - llm_start
+        response += delta
+        if voice:
+            for sentence in splitter.feed(delta):
+                synthesizer.submit(sentence)
+            if first_audio is None and synthesizer.next_clip() is not None:
+                first_audio = time.perf_counter()
+    timings["llm_total"] = time.perf_counter() - llm_start
+
+    if voice:
+        tts_start = time.perf_counter()
+        for sentence in splitter.flush():
+            synthesizer.submit(sentence)
+        synthesizer.close()
+        while not synthesizer.finished:
+            synthesizer.next_clip(block=True)
+            first_audio = first_audio or time.perf_counter()
+        timings["tts_tail"] = time.perf_counter() - tts_start
+        if first_audio is not None:
+            timings["first_audio"] = first_audio - turn_start
+
+    stages.start("assistant_history", timed, timings, "assistant_history", history.append, chat_id, {"role": "assistant", "content": response}, after=("user_history",))
+    counter.increment(queries=1, responses=1)
+    stages.result("assistant_history")
+    timings["total"] = time.perf_counter() - turn_start
+    return timings
+
+def bench_turns(db, history, counter, queries, turns, voice):
+    per_stage = {}
+    chat_id = "benchmark"
+    for i in range(turns):
+        for name, seconds in run_turn(db, history, counter, chat_id, queries[i % len(queries)], voice).items():
+            per_stage.setdefault(name, []).append(seconds)
+    return {name: summarize(timings) for name, timings in per_stage.items()}
+
+def flatten(results):
+    metrics = {}
+    for section, values in results.items():
+        for key, value in values.items():
+            if isinstance(value, dict):
+                for metric, number in value.items():
+                    metrics[f"{section}.{key}.{metric}"] = number
+            elif key.endswith("_per_second") or key.endswith("_ms"):
+                metrics[f"{section}.{key}"] = value
+    return metrics
+
+def check_regressions(metrics, baseline, tolerance):
+    regressions = []
+    for name, expected in baseline.items():
+        actual = metrics.get(name)
+        if actual is None or not expected:
+            continue
+        if name.endswith("_per_second"):
+            change = (expected - actual) / expected
+        else:
+            change = (actual - expected) / expected
+        if change > tolerance:
+            regressions.append((name, expected, actual, change))
+    return regressions
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of ingestion, retrieval and chat turns.")
+    parser.add_argument("--pdfs", type=int, default=5, help="Synthetic PDFs to ingest")
+    parser.add_argument("--pages", type=int, default=20, help="Pages per synthetic PDF")
+    parser.add_argument("--pdf-dir", help="Ingest the PDFs in this directory instead of synthetic ones")
+    parser.add_argument("--queries", help="File with one query per line")
+    parser.add_argument("--repeats", type=int, default=20, help="Passes over the queries for retrieval")
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--voice", action="store_true", help="Run turns through ASR and sentence-level TTS")
+    parser.add_argument("--real-embeddings", action="store_true", help="Use the FastEmbed model instead of a fake")
+    parser.add_argument("--gcs-latency", type=float, default=0.02, help="Seconds per fake GCS call")
+    parser.add_argument("--llm-ttft", type=float, default=0.3, help="Fake MaaS time to first token")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--speech-latency", type=float, default=0.15, help="Seconds per fake ASR/TTS request")
+    parser.add_argument("--profile", default="default", help="Baseline name for this configuration")
+    parser.add_argument("--baselines", default=BASELINES_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="Exit non-zero if a metric regressed against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    args = parser.parse_args()
+
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    # Keep the index, chat WAL and anything else written to the working
+    # directory away from a real local index.
+    workdir = tempfile.mkdtemp(prefix="aiysha-bench-")
+    os.chdir(workdir)
+    set_index_root(os.path.join(workdir, "chroma_db"))
+
+    bucket = FakeBucket(latency=args.gcs_latency)
+    set_bucket(bucket)
+    if not args.real_embeddings:
+        set_embedding_function(DeterministicFakeEmbedding(size=EMBEDDING_DIMENSION))
+        set_token_length_function(estimate_tokens)
+    llm_server = start_fake_llm_server(ttft=args.llm_ttft, tokens_per_second=args.llm_tokens_per_second)
+    set_openai_client(openai.OpenAI(base_url=f"{llm_server.base_url}/v1", api_key="fake"))
+    speech_server = start_fake_speech_server(latency=args.speech_latency)
+    audio_processor.ASR_ENDPOINT = f"{speech_server.base_url}/asr"
+    audio_processor.TTS_ENDPOINT = f"{speech_server.base_url}/tts"
+    history = ChatHistoryStore(wal_dir=os.path.join(workdir, "wal"))
+    counter = ShardedCounter(shard_id="benchmark")
+
+    try:
+        results = {"ingestion": bench_ingestion(bucket, args)}
+        db = get_vector_store()
+        results["retrieval"] = bench_retrieval(db, queries, args.repeats)
+        results["turn"] = bench_turns(db, history, counter, queries, args.turns, args.voice)
+    finally:
+        history.flush()
+        counter.stop()
+        llm_server.shutdown()
+        speech_server.shutdown()
+        os.chdir("/")
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    ingestion = results["ingestion"]
+    print(f"ingestion: {ingestion['files']} files, {ingestion['pages']} pages, {ingestion['chunks']} chunks in {ingestion['seconds']:.2f}s "
+          f"({ingestion['pages_per_second']:.1f} pages/s, {ingestion['chunks_per_second']:.1f} chunks/s)")
+    print(f"retrieval: p50 {results['retrieval']['p50_ms']:.2f} ms, p99 {results['retrieval']['p99_ms']:.2f} ms")
+    print(f"{'turn stage':>18} {'p50 (ms)':>10} {'p99 (ms)':>10}")
+    for name, values in results["turn"].items():
+        print(f"{name:>18} {values['p50_ms']:>10.1f} {values['p99_ms']:>10.1f}")
+    print(f"fake GCS calls: {dict(bucket.calls)}")
+
+    metrics = flatten(results)
+    baselines = load_baselines(args.baselines)
+    if args.save_baseline:
+        baselines[args.profile] = metrics
+        with open(args.baselines, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Saved baseline '{args.profile}' to {args.baselines}")
+    if args.check:
+        if args.profile not in baselines:
+            print(f"No baseline '{args.profile}' in {args.baselines}; run with --save-baseline first")
+            sys.exit(2)
+        regressions = check_regressions(metrics, baselines[args.profile], args.tolerance)
+        for name, expected, actual, change in regressions:
+            print(f"REGRESSION {name}: {expected:.2f} -> {actual:.2f} ({change:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against baseline '{args.profile}'")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import os
+import time
+import base64
+import hashlib
+import threading
+from collections import Counter
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+# In-memory stand-in for a google.cloud.storage Bucket, covering the calls the
+# app makes (blob/get_blob/list_blobs/copy_blob, uploads and downloads with generation
+# preconditions, delete). Install it with gcs_client.set_bucket(FakeBucket()).
+# Every call sleeps for latency seconds to approximate a GCS round trip.
+
+class FakeBucket:
+    def __init__(self, name: str = "fake-bucket", latency: float = 0.0):
+        self.name = name
+        self.latency = latency
+        self.calls = Counter()
+        self._objects = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _call(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _read(self, name):
+        with self._lock:
+            return self._objects.get(name)
+
+    def _write(self, name, data, content_type, if_generation_match, metadata=None):
+        with self._lock:
+            current = self._objects.get(name)
+            if if_generation_match is not None and (current["generation"] if current else 0) != if_generation_match:
+                raise PreconditionFailed(f"Generation mismatch for {name}")
+            self._generation += 1
+            self._objects[name] = {"data": data, "generation": self._generation, "content_type": content_type, "metadata": metadata}
+            return self._objects[name]
+
+    def _delete(self, name, if_generation_match=None):
+        with self._lock:
+            current = self._objects.get(name)
+            if current is None:
+                raise NotFound(f"No such object: {self.name}/{name}")
+            if if_generation_match is not None and current["generation"] != if_generation_match:
+                raise PreconditionFailed(f"Generation mismatch for {name}")
+            del self._objects[name]
+
+    def blob(self, name: str):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str):
+        self._call("get")
+        entry = self._read(name)
+        return FakeBlob(self, name, entry) if entry is not None else None
+
+    def list_blobs(self, prefix: str = ""):
+        self._call("list")
+        with self._lock:
+            entries = sorted((name, entry) for name, entry in self._objects.items() if name.startswith(prefix))
+        return [FakeBlob(self, name, entry) for name, entry in entries]
+
+    def copy_blob(self, blob, destination_bucket, new_name: str):
+        self._call("copy")
+        entry = self._read(blob.name)
+        if entry is None:
+            raise NotFound(f"No such object: {self.name}/{blob.name}")
+        return FakeBlob(destination_bucket, new_name, destination_bucket._write(new_name, entry["data"], entry["content_type"], None, entry["metadata"]))
+
+    def put(self, name: str, data: bytes, content_type: str | None = None):
+        # Seeds an object without counting it as a call
+        self._write(name, data, content_type, None)
+
+    def total_bytes(self):
+        with self._lock:
+            return sum(len(entry["data"]) for entry in self._objects.values())
+
+class FakeBlob:
+    def __init__(self, bucket: FakeBucket, name: str, entry=None):
+        self.bucket = bucket
+        self.name = name
+        self._set(entry)
+
+    def _set(self, entry):
+        self.generation = entry["generation"] if entry else None
+        self.size = len(entry["data"]) if entry else None
+        self.content_type = entry["content_type"] if entry else None
+        self.metadata = entry["metadata"] if entry else None
+        self.md5_hash = base64.b64encode(hashlib.md5(entry["data"]).digest()).decode("utf-8") if entry else None
+
+    @property
+    def public_url(self):
+        return f"https://storage.googleapis.com/{self.bucket.name}/{self.name}"
+
+    def exists(self):
+        self.bucket._call("get")
+        return self.bucket._read(self.name) is not None
+
+    def reload(self):
+        self.bucket._call("get")
+        entry = self.bucket._read(self.name)
+        if entry is None:
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        self._set(entry)
+
+    def upload_from_string(self, data, content_type: str | None = None, if_generation_match: int | None = None):
+        self.bucket._call("upload")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._set(self.bucket._write(self.name, data, content_type, if_generation_match, self.metadata))
+
+    def upload_from_file(self, file_obj, content_type: str | None = None, if_generation_match: int | None = None):
+        self.upload_from_string(file_obj.read(), content_type=content_type, if_generation_match=if_generation_match)
+
+    def upload_from_filename(self, filename: str, content_type: str | None = None, if_generation_match: int | None = None):
+        with open(filename, "rb") as f:
+            self.upload_from_string(f.read(), content_type=content_type, if_generation_match=if_generation_match)
+
+    def download_as_bytes(self, if_generation_match: int | None = None):
+        self.bucket._call("download")
+        entry = self.bucket._read(self.name)
+        if entry is None:
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        if if_generation_match is not None and entry["generation"] != if_generation_match:
+            raise PreconditionFailed(f"Generation mismatch for {self.name}")
+        self._set(entry)
+        return entry["data"]
+
+    def download_as_string(self, if_generation_match: int | None = None):
+        return self.download_as_bytes(if_generation_match=if_generation_match)
+
+    def download_as_text(self, encoding: str = "utf-8", if_generation_match: int | None = None):
+        return self.download_as_bytes(if_generation_match=if_generation_match).decode(encoding)
+
+    def download_to_filename(self, filename: str, if_generation_match: int | None = None):
+        data = self.download_as_bytes(if_generation_match=if_generation_match)
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with open(filename, "wb") as f:
+            f.write(data)
+
+    def delete(self, if_generation_match: int | None = None):
+        self.bucket._call("delete")
+        self.bucket._delete(self.name, if_generation_match)
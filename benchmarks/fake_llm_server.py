@@ -0,0 +1,120 @@
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the OpenAI-compatible MaaS chat completions endpoint,
+# for exercising llm_interface without network access. Any POST whose path
+# contains /chat/completions is answered; stream=true gets server-sent events.
+#
+#   time to first token  ~ ttft (+/- jitter)
+#   then tokens_per_second words per second
+#
+#   python -m benchmarks.fake_llm_server --port 8091 --ttft 0.4 --tokens-per-second 40
+#
+# In-process, point llm_interface at it with
+#   set_openai_client(openai.OpenAI(base_url=f"{server.base_url}/v1", api_key="fake"))
+
+DEFAULT_REPLY = (
+    "For oily skin, a long-wear matte foundation over a mattifying primer works well. "
+    "Set the T-zone with a light layer of translucent powder. "
+    "Blotting papers during the day keep shine down without adding more product."
+)
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, ttft=0.0, jitter=0.0, tokens_per_second=0.0, error_rate=0.0, reply=DEFAULT_REPLY):
+        super().__init__(address, FakeLLMHandler)
+        self.ttft = ttft
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.reply = reply
+        self.requests = {"stream": 0, "complete": 0}
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _completion(self, model, **fields):
+        return {"id": "chatcmpl-fake", "created": int(time.time()), "model": model, **fields}
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if "/chat/completions" not in self.path:
+            return self._send_json(404, {"error": {"message": "not found"}})
+
+        server = self.server
+        stream = bool(request.get("stream"))
+        model = request.get("model", "fake")
+        with server.lock:
+            server.requests["stream" if stream else "complete"] += 1
+        time.sleep(max(0.0, server.ttft + random.uniform(-server.jitter, server.jitter)))
+        if random.random() < server.error_rate:
+            return self._send_json(503, {"error": {"message": "unavailable"}})
+
+        words = server.reply.split(" ")
+        delay = 1.0 / server.tokens_per_second if server.tokens_per_second else 0.0
+        if not stream:
+            time.sleep(delay * len(words))
+            return self._send_json(200, self._completion(
+                model,
+                object="chat.completion",
+                choices=[{"index": 0, "message": {"role": "assistant", "content": server.reply}, "finish_reason": "stop"}],
+                usage={"prompt_tokens": 0, "completion_tokens": len(words), "total_tokens": len(words)},
+            ))
+
+        # No Content-Length: the response ends when the connection closes
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(delay)
+            chunk = self._completion(
+                model,
+                object="chat.completion.chunk",
+                choices=[{"index": 0, "delta": {"role": "assistant", "content": word if i == 0 else f" {word}"}, "finish_reason": None}],
+            )
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        final = self._completion(model, object="chat.completion.chunk", choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+def start_fake_llm_server(port: int = 0, **options):
+    server = FakeLLMServer(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, name="fake-llm-server", daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the MaaS chat completions endpoint.")
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--ttft", type=float, default=0.0, help="Seconds before the first token")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Uniform +/- jitter around the time to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="Streaming rate in words per second (0 for no delay)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    args = parser.parse_args()
+
+    server = FakeLLMServer(("127.0.0.1", args.port), ttft=args.ttft, jitter=args.jitter, tokens_per_second=args.tokens_per_second, error_rate=args.error_rate)
+    print(f"Fake MaaS chat completions listening on {server.base_url}")
+    server.serve_forever()
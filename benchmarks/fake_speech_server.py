@@ -0,0 +1,125 @@
+import io
+import json
+import time
+import wave
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the ASR and TTS endpoints, for exercising
+# audio_processor and http_client without network access.
+#
+#   POST /asr        multipart upload -> {"text": ...}
+#   POST /tts        {"text": ...}    -> {"audio_url": "http://.../audio/<n>.wav"}
+#   GET  /audio/<n>  silent 16 kHz mono WAV, ~CHARS_PER_SECOND chars per second of speech
+#
+#   python -m benchmarks.fake_speech_server --port 8090 --latency 0.2 --stall-rate 0.05
+#   ASR_ENDPOINT=http://127.0.0.1:8090/asr TTS_ENDPOINT=http://127.0.0.1:8090/tts streamlit run app.py
+
+SAMPLE_RATE = 16000
+CHARS_PER_SECOND = 15
+
+def silent_wav(seconds: float):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(b"\0\0" * int(SAMPLE_RATE * seconds))
+    return buffer.getvalue()
+
+class FakeSpeechServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0, stall_rate=0.0, stall_seconds=30.0, transcript="What foundation works best for oily skin?"):
+        super().__init__(address, FakeSpeechHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.transcript = transcript
+        self.clips = {}
+        self.requests = {"asr": 0, "tts": 0, "audio": 0}
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+class FakeSpeechHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _simulate(self):
+        # Returns False when this request should fail with a 503
+        server = self.server
+        if random.random() < server.stall_rate:
+            time.sleep(server.stall_seconds)
+        time.sleep(max(0.0, server.latency + random.uniform(-server.jitter, server.jitter)))
+        return random.random() >= server.error_rate
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path.startswith("/asr"):
+            with self.server.lock:
+                self.server.requests["asr"] += 1
+            if not self._simulate():
+                return self._send_json(503, {"error": "unavailable"})
+            return self._send_json(200, {"text": self.server.transcript})
+        if self.path.startswith("/tts"):
+            with self.server.lock:
+                self.server.requests["tts"] += 1
+            if not self._simulate():
+                return self._send_json(503, {"error": "unavailable"})
+            text = json.loads(body or b"{}").get("text", "")
+            with self.server.lock:
+                clip_id = len(self.server.clips)
+                self.server.clips[clip_id] = silent_wav(max(0.2, len(text) / CHARS_PER_SECOND))
+            return self._send_json(200, {"audio_url": f"{self.server.base_url}/audio/{clip_id}.wav"})
+        self._send_json(404, {"error": "not found"})
+
+    def do_GET(self):
+        if self.path.startswith("/audio/"):
+            with self.server.lock:
+                self.server.requests["audio"] += 1
+                clip = self.server.clips.get(int(self.path.rsplit("/", 1)[-1].split(".")[0]))
+            if clip is None:
+                return self._send_json(404, {"error": "not found"})
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/wav")
+            self.send_header("Content-Length", str(len(clip)))
+            self.end_headers()
+            self.wfile.write(clip)
+            return
+        self._send_json(404, {"error": "not found"})
+
+def start_fake_speech_server(port: int = 0, **options):
+    server = FakeSpeechServer(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, name="fake-speech-server", daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the ASR and TTS endpoints.")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Uniform +/- jitter around the latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="Fraction of requests that stall")
+    parser.add_argument("--stall-seconds", type=float, default=30.0)
+    args = parser.parse_args()
+
+    server = FakeSpeechServer(("127.0.0.1", args.port), latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, stall_rate=args.stall_rate, stall_seconds=args.stall_seconds)
+    print(f"Fake ASR/TTS listening on {server.base_url}")
+    server.serve_forever()
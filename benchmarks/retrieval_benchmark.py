@@ -0,0 +1,59 @@
+import time
+import argparse
+import statistics
+from vector_store import get_vector_store, get_lexical_index, embed_query, dense_search, hybrid_search
+
+# Latency of dense-only vs. hybrid (dense + BM25, rank-fused) retrieval over
+# the serving index. Query embeddings are computed up front so both paths are
+# measured on search cost alone.
+#
+#   python -m benchmarks.retrieval_benchmark --queries queries.txt
+
+DEFAULT_QUERIES = [
+    "best foundation for oily skin",
+    "how do I apply liquid eyeliner",
+    "what shade of concealer for dark circles",
+    "is niacinamide safe with vitamin c",
+    "long lasting matte lipstick",
+    "NC20 vs NW20 foundation",
+    "primer for large pores",
+    "how to contour a round face",
+]
+
+def percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def measure(search, queries, db, k, repeats):
+    timings = []
+    for _ in range(repeats):
+        for query in queries:
+            start = time.perf_counter()
+            search(query, db, k=k)
+            timings.append(time.perf_counter() - start)
+    return timings
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dense vs. hybrid retrieval latency.")
+    parser.add_argument("--queries", help="File with one query per line")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    db = get_vector_store()
+    get_lexical_index(db)
+    for query in queries:
+        embed_query(query)
+
+    print(f"{'mode':>8} {'p50 (ms)':>10} {'p99 (ms)':>10} {'mean (ms)':>10}")
+    for name, search in (("dense", dense_search), ("hybrid", hybrid_search)):
+        timings = measure(search, queries, db, args.k, args.repeats)
+        print(f"{name:>8} {percentile(timings, 0.5) * 1000:>10.2f} {percentile(timings, 0.99) * 1000:>10.2f} {statistics.mean(timings) * 1000:>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import uuid
+import atexit
+import logging
+import threading
+from functools import lru_cache
+from collections import defaultdict
+from gcs_client import get_bucket
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from metrics import timed
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+HISTORY_PREFIX = "history/chats/"
+CHAT_WAL_DIR = os.getenv("CHAT_WAL_DIR", "/tmp/aiysha_chat_wal")
+FLUSH_INTERVAL_SECONDS = float(os.getenv("CHAT_FLUSH_INTERVAL_SECONDS", "2"))
+COMPACT_AFTER_SEGMENTS = int(os.getenv("CHAT_COMPACT_AFTER_SEGMENTS", "20"))
+
+# Layout per conversation:
+#   history/chats/<id>.json                 compacted base, {"messages": [...], "compacted_segments": [<segment>, ...]}
+#                                           (older chats hold a bare message list, or a
+#                                           "compacted_through" name watermark, here)
+#   history/chats/<id>/segments/<name>.json small batches of records appended since
+# Records are {"op": "append", "message": {...}} or {"op": "reset"}. Segment names
+# start with a zero-padded timestamp so listing order is replay order. The base
+# lists exactly which segments it folded in: a segment that lands late, or whose
+# writer's clock lags, sorts before folded ones but is still read.
+
+def base_blob_name(chat_id):
+    return f"{HISTORY_PREFIX}{chat_id}.json"
+
+def segment_prefix(chat_id):
+    return f"{HISTORY_PREFIX}{chat_id}/segments/"
+
+def segment_name(blob):
+    return blob.name.rsplit("/", 1)[-1]
+
+def apply_records(messages, records):
+    for record in records:
+        if record["op"] == "append":
+            messages.append(record["message"])
+        elif record["op"] == "reset":
+            messages.clear()
+    return messages
+
+class ChatHistoryStore:
+    def __init__(self, wal_dir=CHAT_WAL_DIR, flush_interval=FLUSH_INTERVAL_SECONDS, compact_after=COMPACT_AFTER_SEGMENTS):
+        self.wal_dir = wal_dir
+        self.flush_interval = flush_interval
+        self.compact_after = compact_after
+        self._instance_id = uuid.uuid4().hex[:8]
+        self._sequence = 0
+        self._pending = defaultdict(list)
+        self._segment_counts = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        os.makedirs(wal_dir, exist_ok=True)
+        self._recover_wal()
+        self._thread = threading.Thread(target=self._run, name="chat-history-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def _wal_path(self, chat_id):
+        return os.path.join(self.wal_dir, f"{chat_id}.jsonl")
+
+    def _recover_wal(self):
+        # Records written locally but never flushed by a previous process
+        for name in os.listdir(self.wal_dir):
+            if not name.endswith(".jsonl"):
+                continue
+            chat_id = name[:-len(".jsonl")]
+            with open(os.path.join(self.wal_dir, name)) as f:
+                records = [json.loads(line) for line in f if line.strip()]
+            if records:
+                self._pending[chat_id].extend(records)
+                logger.info(f"Recovered {len(records)} unflushed history records for chat {chat_id}")
+        if self._pending:
+            self._wake.set()
+
+    def _rewrite_wal(self, chat_id):
+        records = self._pending.get(chat_id)
+        path = self._wal_path(chat_id)
+        if not records:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+        os.replace(temp_path, path)
+
+    def _record(self, chat_id, record):
+        with self._lock:
+            with open(self._wal_path(chat_id), "a") as f:
+                f.write(json.dumps(record) + "\n")
+            self._pending[chat_id].append(record)
+        self._wake.set()
+
+    def append(self, chat_id, message):
+        self._record(chat_id, {"op": "append", "message": message})
+
+    def reset(self, chat_id):
+        self._record(chat_id, {"op": "reset"})
+
+    def _next_segment_name(self):
+        with self._lock:
+            self._sequence += 1
+            return f"{time.time_ns():020d}-{self._instance_id}-{self._sequence:06d}.json"
+
+    @timed("gcs.history_segment_upload")
+    def _upload_segment(self, chat_id, records):
+        blob = get_bucket().blob(f"{segment_prefix(chat_id)}{self._next_segment_name()}")
+        blob.upload_from_string(json.dumps(records), content_type="application/json")
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batches = {chat_id: records for chat_id, records in self._pending.items() if records}
+                for chat_id in batches:
+                    self._pending[chat_id] = []
+
+            for chat_id, records in batches.items():
+                try:
+                    self._upload_segment(chat_id, records)
+                except Exception as e:
+                    logger.error(f"Error flushing chat history for {chat_id}: {str(e)}")
+                    with self._lock:
+                        self._pending[chat_id] = records + self._pending[chat_id]
+                    continue
+
+                with self._lock:
+                    self._rewrite_wal(chat_id)
+                    if not self._pending[chat_id]:
+                        del self._pending[chat_id]
+                    count = self._segment_counts.get(chat_id, 0) + 1
+                    self._segment_counts[chat_id] = count
+                if count >= self.compact_after:
+                    self.compact(chat_id)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def _read_base(self, chat_id):
+        # Returns (messages, is_folded(segment name), generation)
+        blob = get_bucket().get_blob(base_blob_name(chat_id))
+        if blob is None:
+            return [], lambda name: False, None
+        data = json.loads(blob.download_as_string())
+        if isinstance(data, list):
+            return data, lambda name: False, blob.generation
+        if "compacted_through" in data:
+            return data.get("messages", []), lambda name: name <= data["compacted_through"], blob.generation
+        compacted_segments = set(data.get("compacted_segments", []))
+        return data.get("messages", []), compacted_segments.__contains__, blob.generation
+
+    @timed("gcs.history_read")
+    def _read_remote(self, chat_id):
+        # Returns (messages, unfolded segments, segments already folded into the
+        # base but not yet deleted, base generation)
+        messages, is_folded, generation = self._read_base(chat_id)
+        listed = sorted(get_bucket().list_blobs(prefix=segment_prefix(chat_id)), key=lambda blob: blob.name)
+        folded = [blob for blob in listed if is_folded(segment_name(blob))]
+        segments = [blob for blob in listed if not is_folded(segment_name(blob))]
+        for blob in segments:
+            apply_records(messages, json.loads(blob.download_as_string()))
+        return messages, segments, folded, generation
+
+    def load(self, chat_id):
+        messages, segments, _, _ = self._read_remote(chat_id)
+        with self._lock:
+            self._segment_counts[chat_id] = len(segments)
+            pending = list(self._pending.get(chat_id, []))
+        return apply_records(messages, pending)
+
+    @timed("gcs.history_compact")
+    def compact(self, chat_id):
+        # Folds the segments into the base blob. The generation match keeps two
+        # instances from overwriting each other's compaction; segments are only
+        # deleted after the base that lists them is written. Folded segments a
+        # previous compaction failed to delete stay listed until they are gone.
+        try:
+            messages, segments, folded, generation = self._read_remote(chat_id)
+            if not segments:
+                return
+            get_bucket().blob(base_blob_name(chat_id)).upload_from_string(
+                json.dumps({"messages": messages, "compacted_segments": [segment_name(blob) for blob in folded + segments]}),
+                content_type="application/json",
+                if_generation_match=generation or 0,
+            )
+            for blob in folded + segments:
+                try:
+                    blob.delete()
+                except NotFound:
+                    pass
+            with self._lock:
+                self._segment_counts[chat_id] = 0
+            logger.info(f"Compacted {len(segments)} history segments for chat {chat_id}")
+        except PreconditionFailed:
+            logger.info(f"Chat {chat_id} was compacted concurrently, skipping")
+        except Exception as e:
+            logger.error(f"Error compacting chat history for {chat_id}: {str(e)}")
+
+@lru_cache(maxsize=1)
+def get_chat_history_store():
+    return ChatHistoryStore()
@@ -0,0 +1,161 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
+from collections import defaultdict
+from lexical_index import tokenize
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SIMHASH_BITS = 64
+SHINGLE_SIZE = 3
+# Below this many tokens a SimHash is too noisy to call two chunks near-duplicates;
+# such chunks are only deduplicated on exact (normalized) text.
+MIN_SIMHASH_TOKENS = 8
+NEAR_DUPLICATE_DISTANCE = int(os.getenv("CHUNK_NEAR_DUPLICATE_DISTANCE", "3"))
+# Chunks are only dropped in favour of another file's chunk up to this length,
+# i.e. repeated headers, footers and disclaimers. Longer text is kept even if
+# another file holds it too, since that file may be revised or removed later.
+BOILERPLATE_MAX_TOKENS = int(os.getenv("CHUNK_BOILERPLATE_MAX_TOKENS", "64"))
+
+def normalize_text(text: str):
+    return " ".join(tokenize(text))
+
+def text_digest(text: str):
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+def identifier_digest(text: str):
+    # Tokens with digits (shade codes like NC20, sizes, prices) carry the facts
+    # that set otherwise identical chunks apart; near-duplicates must share all of them
+    identifiers = sorted({token for token in tokenize(text) if any(char.isdigit() for char in token)})
+    return hashlib.sha1(" ".join(identifiers).encode("utf-8")).hexdigest()
+
+def simhash(text: str):
+    # 64-bit SimHash over word 3-shingles; None for texts too short to judge
+    tokens = tokenize(text)
+    if len(tokens) < MIN_SIMHASH_TOKENS:
+        return None
+    shingles = {" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+    digests = b"".join(hashlib.blake2b(shingle.encode("utf-8"), digest_size=SIMHASH_BITS // 8).digest() for shingle in shingles)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(len(shingles), -1), axis=1, bitorder="little")
+    majority = bits.sum(axis=0) * 2 > len(shingles)
+    return int.from_bytes(np.packbits(majority, bitorder="little").tobytes(), "little")
+
+class DuplicateIndex:
+    # Exact digests and SimHash signatures of the chunks stored in one index
+    # version. Signatures are split into max_distance + 1 bands, so any two
+    # within max_distance bits agree exactly on at least one band and only
+    # chunks sharing a band are compared. Chunks are only near-duplicates if
+    # they also contain the same identifier tokens.
+    def __init__(self, max_distance: int = NEAR_DUPLICATE_DISTANCE):
+        self.max_distance = max_distance
+        self._band_count = max_distance + 1
+        self._band_width = SIMHASH_BITS // self._band_count
+        self._digests = {}
+        self._chunk_digests = {}
+        self._signatures = {}
+        self._identifiers = {}
+        self._bands = [defaultdict(set) for _ in range(self._band_count)]
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def _band_keys(self, signature):
+        mask = (1 << self._band_width) - 1
+        return [signature >> (band * self._band_width) & mask for band in range(self._band_count)]
+
+    def add(self, chunk_ids, texts):
+        with self._lock:
+            self.remove([chunk_id for chunk_id in chunk_ids if chunk_id in self._signatures])
+            for chunk_id, text in zip(chunk_ids, texts):
+                digest = text_digest(text)
+                self._digests.setdefault(digest, chunk_id)
+                self._chunk_digests[chunk_id] = digest
+                signature = simhash(text)
+                self._signatures[chunk_id] = signature
+                if signature is not None:
+                    self._identifiers[chunk_id] = identifier_digest(text)
+                    for band, key in enumerate(self._band_keys(signature)):
+                        self._bands[band][key].add(chunk_id)
+
+    def remove(self, chunk_ids):
+        with self._lock:
+            for chunk_id in set(chunk_ids):
+                signature = self._signatures.pop(chunk_id, None)
+                self._identifiers.pop(chunk_id, None)
+                if signature is not None:
+                    for band, key in enumerate(self._band_keys(signature)):
+                        self._bands[band][key].discard(chunk_id)
+                digest = self._chunk_digests.pop(chunk_id, None)
+                if digest is not None and self._digests.get(digest) == chunk_id:
+                    del self._digests[digest]
+
+    def find(self, text, ignore_prefix: str | None = None):
+        # Returns (kind, chunk_id) of a stored chunk duplicating text, or None.
+        # Chunks whose ID starts with ignore_prefix are not considered.
+        def ignored(chunk_id):
+            return ignore_prefix is not None and chunk_id.startswith(ignore_prefix)
+
+        with self._lock:
+            chunk_id = self._digests.get(text_digest(text))
+            if chunk_id is not None and not ignored(chunk_id):
+                return "exact", chunk_id
+            signature = simhash(text)
+            if signature is None:
+                return None
+            identifiers = identifier_digest(text)
+            for band, key in enumerate(self._band_keys(signature)):
+                for candidate in self._bands[band].get(key, ()):
+                    if (not ignored(candidate) and self._identifiers.get(candidate) == identifiers
+                            and (self._signatures[candidate] ^ signature).bit_count() <= self.max_distance):
+                        return "near", candidate
+            return None
+
+    def save(self, path):
+        with self._lock:
+            data = {"max_distance": self.max_distance, "digests": self._digests, "signatures": self._signatures, "identifiers": self._identifiers}
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        index = cls(max_distance=data["max_distance"])
+        index._digests = data["digests"]
+        index._chunk_digests = {chunk_id: digest for digest, chunk_id in data["digests"].items()}
+        # Files saved before identifiers were recorded leave them unknown, and
+        # those chunks are then only matched exactly
+        index._identifiers = data.get("identifiers", {})
+        for chunk_id, signature in data["signatures"].items():
+            index._signatures[chunk_id] = signature
+            if signature is not None:
+                for band, key in enumerate(index._band_keys(signature)):
+                    index._bands[band][key].add(chunk_id)
+        return index
+
+def drop_duplicate_chunks(chunks, index: DuplicateIndex):
+    # Filters one file's chunks (IDs already assigned) against each other and,
+    # for boilerplate-length chunks, against the stored index. Stored chunks of
+    # the same file are not matched: a re-ingested file replaces its old chunks
+    # rather than being deduplicated against them.
+    # Returns (kept, {"exact": n, "near": n}).
+    batch = DuplicateIndex(max_distance=index.max_distance)
+    kept = []
+    dropped = {"exact": 0, "near": 0}
+    for chunk in chunks:
+        match = batch.find(chunk.page_content)
+        if match is None and len(tokenize(chunk.page_content)) <= BOILERPLATE_MAX_TOKENS:
+            match = index.find(chunk.page_content, ignore_prefix=f"{chunk.metadata.get('source')}:")
+        if match is not None:
+            dropped[match[0]] += 1
+            continue
+        batch.add([chunk.metadata["id"]], [chunk.page_content])
+        kept.append(chunk)
+    return kept, dropped
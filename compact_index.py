@@ -0,0 +1,125 @@
+import os
+import json
+import shutil
+import logging
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COMPACT_MODES = ("int8", "binary")
+SEARCH_BLOCK_ROWS = 65536
+FETCH_BATCH_SIZE = 5000
+DEFAULT_CANDIDATES = 50
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def iter_collection_embeddings(db, batch_size: int = FETCH_BATCH_SIZE):
+    # Pages (ids, float32 vectors) out of a Chroma store
+    offset = 0
+    while True:
+        items = db._collection.get(include=["embeddings"], limit=batch_size, offset=offset)
+        if not items["ids"]:
+            return
+        yield items["ids"], np.asarray(items["embeddings"], dtype=np.float32)
+        offset += len(items["ids"])
+
+def build_compact_index(db, target_dir, mode: str = "int8", dims: int | None = None, rerank: bool = True):
+    # Writes a compact copy of the store's vectors to target_dir:
+    #   codes.npy   int8 codes (per-dimension scale) or packed sign bits, of
+    #               the first dims dimensions, renormalized after truncation
+    #   rerank.npy  float16 full vectors for rescoring the top candidates
+    #   ids.json, meta.json
+    # Built in a temporary directory and swapped in, so readers never see a
+    # half-written index.
+    if mode not in COMPACT_MODES:
+        raise ValueError(f"Unknown compact index mode: {mode}")
+    ids = []
+    blocks = []
+    for batch_ids, vectors in iter_collection_embeddings(db):
+        ids.extend(batch_ids)
+        blocks.append(normalize(vectors))
+    if not ids:
+        logger.info("No vectors to build a compact index from")
+        return None
+    vectors = np.concatenate(blocks)
+    full_dims = vectors.shape[1]
+    dims = min(dims or full_dims, full_dims)
+    truncated = normalize(vectors[:, :dims])
+
+    temp_dir = f"{target_dir}.tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    meta = {"mode": mode, "dims": dims, "full_dims": full_dims, "count": len(ids), "rerank": rerank}
+    if mode == "int8":
+        scale = 127.0 / np.maximum(np.abs(truncated).max(axis=0), 1e-12)
+        codes = np.clip(np.rint(truncated * scale), -127, 127).astype(np.int8)
+        np.save(os.path.join(temp_dir, "scale.npy"), scale.astype(np.float32))
+    else:
+        codes = np.packbits(truncated > 0, axis=1)
+    np.save(os.path.join(temp_dir, "codes.npy"), codes)
+    if rerank:
+        np.save(os.path.join(temp_dir, "rerank.npy"), vectors.astype(np.float16))
+    with open(os.path.join(temp_dir, "ids.json"), "w") as f:
+        json.dump(ids, f)
+    with open(os.path.join(temp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    shutil.rmtree(target_dir, ignore_errors=True)
+    os.replace(temp_dir, target_dir)
+    logger.info(f"Built {mode} compact index of {len(ids)} vectors ({dims} of {full_dims} dims) in {target_dir}")
+    return target_dir
+
+class CompactIndex:
+    # Brute-force search over memory-mapped int8 or binary codes, followed by
+    # an exact rescoring of the best candidates against float16 full vectors.
+    # Only the pages actually touched are read into memory.
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(index_dir, "ids.json")) as f:
+            self.ids = json.load(f)
+        self.mode = self.meta["mode"]
+        self.dims = self.meta["dims"]
+        self.codes = np.load(os.path.join(index_dir, "codes.npy"), mmap_mode="r")
+        self.scale = np.load(os.path.join(index_dir, "scale.npy")) if self.mode == "int8" else None
+        rerank_path = os.path.join(index_dir, "rerank.npy")
+        self.rerank = np.load(rerank_path, mmap_mode="r") if os.path.exists(rerank_path) else None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def nbytes(self):
+        return self.codes.nbytes + (self.rerank.nbytes if self.rerank is not None else 0)
+
+    def _approximate_scores(self, query):
+        scores = np.empty(len(self.ids), dtype=np.float32)
+        if self.mode == "int8":
+            weights = query / self.scale
+            for start in range(0, len(self.ids), SEARCH_BLOCK_ROWS):
+                block = self.codes[start:start + SEARCH_BLOCK_ROWS]
+                scores[start:start + len(block)] = block.astype(np.float32) @ weights
+        else:
+            # Asymmetric: +/-1 codes against the float query ranks better than Hamming distance
+            for start in range(0, len(self.ids), SEARCH_BLOCK_ROWS):
+                bits = np.unpackbits(self.codes[start:start + SEARCH_BLOCK_ROWS], axis=1)[:, :self.dims]
+                scores[start:start + len(bits)] = (bits.astype(np.float32) * 2 - 1) @ query
+        return scores
+
+    def search(self, query_vector, k: int = 3, candidates: int = DEFAULT_CANDIDATES, rerank: bool = True):
+        # Returns [(id, score)] best first; scores are cosine similarities when rescored
+        if not self.ids:
+            return []
+        full_query = normalize(np.asarray(query_vector, dtype=np.float32))
+        scores = self._approximate_scores(normalize(full_query[:self.dims]))
+        candidates = min(max(candidates, k), len(self.ids))
+        top = np.argpartition(-scores, candidates - 1)[:candidates]
+        if rerank and self.rerank is not None:
+            top = np.sort(top)
+            scores = self.rerank[top].astype(np.float32) @ full_query
+            order = np.argsort(-scores)[:k]
+            return [(self.ids[top[i]], float(scores[i])) for i in order]
+        order = top[np.argsort(-scores[top])][:k]
+        return [(self.ids[i], float(scores[i])) for i in order]
@@ -0,0 +1,102 @@
+import os
+import json
+import atexit
+import socket
+import logging
+import threading
+from functools import lru_cache
+from collections import Counter
+from gcs_client import get_bucket
+from google.api_core.exceptions import PreconditionFailed
+from metrics import timed
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CONVERSATION_TRACK_BLOB = "history/count/conversations.txt"
+SHARD_PREFIX = "history/count/shards/"
+FLUSH_INTERVAL_SECONDS = float(os.getenv("COUNTER_FLUSH_INTERVAL_SECONDS", "30"))
+MAX_WRITE_ATTEMPTS = 5
+
+def default_shard_id():
+    return f"{os.getenv('GAE_INSTANCE', socket.gethostname())}-{os.getpid()}"
+
+def read_legacy_counts():
+    # Totals accumulated by the old single-blob counter; now read-only
+    blob = get_bucket().get_blob(CONVERSATION_TRACK_BLOB)
+    if blob is None:
+        return Counter()
+    counts = Counter()
+    for line in blob.download_as_text().splitlines():
+        if ": " in line:
+            name, value = line.split(": ", 1)
+            counts[name.strip()] += int(value)
+    return counts
+
+def read_conversation_counts():
+    counts = read_legacy_counts()
+    for blob in get_bucket().list_blobs(prefix=SHARD_PREFIX):
+        counts.update(json.loads(blob.download_as_text()))
+    return dict(counts)
+
+class ShardedCounter:
+    # Increments are aggregated in memory and added to this instance's own shard
+    # blob on a timer. Each shard has a single writer, and the generation-match
+    # write makes the read-add-write exact even if a shard ID is ever reused.
+    def __init__(self, shard_id=None, flush_interval=FLUSH_INTERVAL_SECONDS):
+        self.shard_id = shard_id or default_shard_id()
+        self.flush_interval = flush_interval
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="conversation-counter", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def increment(self, **amounts):
+        with self._lock:
+            self._pending.update(amounts)
+
+    def _add_to_shard(self, amounts):
+        blob_name = f"{SHARD_PREFIX}{self.shard_id}.json"
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            blob = get_bucket().get_blob(blob_name)
+            counts = Counter(json.loads(blob.download_as_text())) if blob is not None else Counter()
+            counts.update(amounts)
+            try:
+                get_bucket().blob(blob_name).upload_from_string(
+                    json.dumps(counts),
+                    content_type="application/json",
+                    if_generation_match=blob.generation if blob is not None else 0,
+                )
+                return
+            except PreconditionFailed:
+                logger.info(f"Counter shard {blob_name} changed concurrently, retrying")
+        raise RuntimeError(f"Could not update counter shard {blob_name} after {MAX_WRITE_ATTEMPTS} attempts")
+
+    @timed("gcs.counter_flush")
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                amounts, self._pending = self._pending, Counter()
+            if not amounts:
+                return
+            try:
+                self._add_to_shard(amounts)
+            except Exception as e:
+                logger.error(f"Error updating conversation count: {e}")
+                with self._lock:
+                    self._pending.update(amounts)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+@lru_cache(maxsize=1)
+def get_conversation_counter():
+    return ShardedCounter()
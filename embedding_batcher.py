@@ -0,0 +1,90 @@
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future
+from metrics import observe, EMBEDDING_BATCH_SIZES
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EMBED_BATCH_WINDOW_SECONDS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5")) / 1000
+EMBED_MAX_BATCH_SIZE = int(os.getenv("EMBED_MAX_BATCH_SIZE", "32"))
+
+class EmbeddingBatcher:
+    # Funnels single-text embedding requests from any number of threads into
+    # batched embed_documents calls. A worker thread takes the first waiting
+    # request, collects whatever else arrives within window_seconds (up to
+    # max_batch_size) and embeds them in one call, so concurrent sessions
+    # share one ONNX run instead of competing with one run each.
+    def __init__(self, embed_documents, window_seconds: float = EMBED_BATCH_WINDOW_SECONDS, max_batch_size: int = EMBED_MAX_BATCH_SIZE):
+        self.embed_documents = embed_documents
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {"requests": 0, "batches": 0, "queue_seconds": 0.0, "max_queue_seconds": 0.0, "embed_seconds": 0.0}
+
+    def _ensure_worker(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                    self._thread.start()
+
+    def embed(self, text: str, timeout: float | None = None):
+        future = Future()
+        self._queue.put((text, future, time.perf_counter()))
+        self._ensure_worker()
+        return future.result(timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.window_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            texts = list(dict.fromkeys(text for text, _, _ in batch))
+            try:
+                vectors = dict(zip(texts, self.embed_documents(texts)))
+            except Exception as e:
+                logger.error(f"Error embedding batch of {len(texts)} queries: {str(e)}")
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            embed_seconds = time.perf_counter() - started
+            for text, future, _ in batch:
+                future.set_result(vectors[text])
+
+            queue_waits = [started - enqueued_at for _, _, enqueued_at in batch]
+            EMBEDDING_BATCH_SIZES.observe(len(batch))
+            observe("embedding.batch", embed_seconds)
+            for wait in queue_waits:
+                observe("embedding.queue_wait", wait)
+            with self._lock:
+                self._stats["requests"] += len(batch)
+                self._stats["batches"] += 1
+                self._stats["queue_seconds"] += sum(queue_waits)
+                self._stats["max_queue_seconds"] = max(self._stats["max_queue_seconds"], *queue_waits)
+                self._stats["embed_seconds"] += embed_seconds
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        requests = stats["requests"]
+        stats["mean_batch_size"] = requests / stats["batches"] if stats["batches"] else 0.0
+        stats["mean_queue_ms"] = stats.pop("queue_seconds") / requests * 1000 if requests else 0.0
+        stats["max_queue_ms"] = stats.pop("max_queue_seconds") * 1000
+        stats["embedded_per_second"] = requests / stats["embed_seconds"] if stats["embed_seconds"] else 0.0
+        return stats
@@ -0,0 +1,16 @@
+import hashlib
+
+def content_hash(text: str):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def embed_documents(texts, stored, embed):
+    # Vectors for texts, taken from stored (content hash -> vector) where the
+    # same text was embedded before and computed with embed(list_of_texts) for
+    # the rest, each distinct text once. Computed vectors are added to stored
+    # for later batches. Returns (vectors, reused count).
+    hashes = [content_hash(text) for text in texts]
+    reused = sum(1 for text_hash in hashes if text_hash in stored)
+    missing = list(dict.fromkeys(text for text, text_hash in zip(texts, hashes) if text_hash not in stored))
+    if missing:
+        stored.update((content_hash(text), vector) for text, vector in zip(missing, embed(missing)))
+    return [stored[text_hash] for text_hash in hashes], reused
@@ -0,0 +1,23 @@
+import os
+import threading
+from google.cloud import storage
+
+BUCKET_NAME = os.getenv("GCS_BUCKET_NAME", "aiysha-convos")
+
+_bucket = None
+_lock = threading.Lock()
+
+def get_bucket():
+    # Created on first use, so importing a module needs no credentials
+    global _bucket
+    if _bucket is None:
+        with _lock:
+            if _bucket is None:
+                _bucket = storage.Client().bucket(BUCKET_NAME)
+    return _bucket
+
+def set_bucket(bucket):
+    # Points every module at another bucket, e.g. a local stand-in for benchmarks
+    global _bucket
+    with _lock:
+        _bucket = bucket
@@ -0,0 +1,257 @@
+import os
+import json
+import base64
+import shutil
+import tarfile
+import tempfile
+import hashlib
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from gcs_client import get_bucket
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+LOCAL_MANIFEST_NAME = ".sync_manifest.json"
+SNAPSHOT_GENERATION_NAME = ".snapshot_generation"
+# Custom metadata on a snapshot blob: generation of the manifest it was taken with
+SNAPSHOT_MANIFEST_KEY = "manifest_generation"
+SYNC_WORKERS = int(os.getenv("GCS_SYNC_WORKERS", "8"))
+SYNC_DOWN_ATTEMPTS = int(os.getenv("GCS_SYNC_DOWN_ATTEMPTS", "3"))
+SKIP_FILES = {MANIFEST_NAME, LOCAL_MANIFEST_NAME, SNAPSHOT_GENERATION_NAME}
+
+def file_md5(path):
+    # Same encoding as Blob.md5_hash, so local and remote checksums compare directly
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return base64.b64encode(digest.digest()).decode("ascii")
+
+def scan_local_files(local_dir, exclude=()):
+    # exclude names top-level entries of local_dir that are never synced
+    files = {}
+    for root, _, names in os.walk(local_dir):
+        for name in names:
+            if name in SKIP_FILES:
+                continue
+            local_path = os.path.join(root, name)
+            relative_path = os.path.relpath(local_path, local_dir).replace(os.sep, "/")
+            if relative_path.split("/", 1)[0] in exclude:
+                continue
+            files[relative_path] = {"md5": file_md5(local_path), "size": os.path.getsize(local_path)}
+    return files
+
+def object_name(relative_path, entry):
+    # Files uploaded by sync_up live in objects named after the file plus a
+    # per-sync suffix; listings and manifests from before that name the file itself
+    return entry.get("object", relative_path)
+
+def read_local_manifest(local_dir):
+    path = os.path.join(local_dir, LOCAL_MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f).get("files", {})
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable local manifest {path}: {str(e)}")
+        return {}
+
+def write_local_manifest(local_dir, files):
+    path = os.path.join(local_dir, LOCAL_MANIFEST_NAME)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"files": files}, f)
+    os.replace(temp_path, path)
+
+def read_remote_manifest(prefix):
+    blob = get_bucket().blob(f"{prefix}{MANIFEST_NAME}")
+    if not blob.exists():
+        return None
+    return json.loads(blob.download_as_text()).get("files", {})
+
+def list_remote_files(prefix):
+    # Manifest is written last by sync_up, so it describes a complete upload.
+    # Prefixes uploaded before manifests existed fall back to a listing.
+    files = read_remote_manifest(prefix)
+    if files is not None:
+        return files
+    files = {}
+    for blob in get_bucket().list_blobs(prefix=prefix):
+        relative_path = blob.name[len(prefix):]
+        if not relative_path or relative_path in SKIP_FILES:
+            continue
+        files[relative_path] = {"md5": blob.md5_hash, "size": blob.size, "generation": blob.generation}
+    return files
+
+def sync_up(local_dir, prefix, workers: int = SYNC_WORKERS, exclude=(), if_generation_match: int | None = None):
+    # Changed files are uploaded to new objects and the manifest naming them is
+    # written last, so no object a published manifest names is ever overwritten;
+    # objects only the previous manifest named are deleted afterwards. With
+    # if_generation_match the manifest is only written while it is still at that
+    # generation (0: absent), so two writers cannot both commit on the same base:
+    # the loser's objects are deleted again and PreconditionFailed is raised.
+    remote_files = list_remote_files(prefix)
+    local_files = scan_local_files(local_dir, exclude)
+
+    changed = [path for path, entry in local_files.items() if remote_files.get(path, {}).get("md5") != entry["md5"]]
+    removed = [path for path in remote_files if path not in local_files]
+    suffix = uuid.uuid4().hex[:12]
+    uploaded = {}
+
+    def upload(relative_path):
+        name = f"{relative_path}.{suffix}"
+        blob = get_bucket().blob(f"{prefix}{name}")
+        blob.upload_from_filename(os.path.join(local_dir, relative_path), if_generation_match=0)
+        uploaded[relative_path] = {"object": name, "generation": blob.generation}
+
+    def delete(name):
+        try:
+            get_bucket().blob(f"{prefix}{name}").delete()
+        except NotFound:
+            pass
+
+    manifest_blob = get_bucket().blob(f"{prefix}{MANIFEST_NAME}")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        def discard_uploads():
+            list(executor.map(delete, [entry["object"] for entry in uploaded.values()]))
+
+        # Every upload finishes before any failure is raised, so all of this
+        # sync's objects are known if they have to be deleted again
+        futures = [executor.submit(upload, path) for path in changed]
+        wait(futures)
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            discard_uploads()
+            raise
+        manifest = {}
+        for path, entry in local_files.items():
+            remote_entry = remote_files.get(path, {})
+            manifest[path] = {**entry, **uploaded.get(path, {"object": object_name(path, remote_entry), "generation": remote_entry.get("generation")})}
+        try:
+            manifest_blob.upload_from_string(json.dumps({"files": manifest}), content_type="application/json", if_generation_match=if_generation_match)
+        except PreconditionFailed:
+            discard_uploads()
+            raise
+        live = {entry["object"] for entry in manifest.values()}
+        list(executor.map(delete, {object_name(path, entry) for path, entry in remote_files.items()} - live))
+    write_local_manifest(local_dir, manifest)
+
+    logger.info(f"Synced {local_dir} to gs://{get_bucket().name}/{prefix}: {len(changed)} uploaded, {len(removed)} deleted, {len(local_files) - len(changed)} unchanged")
+    return len(changed), len(removed), str(manifest_blob.generation)
+
+def remote_manifest_generation(prefix):
+    blob = get_bucket().get_blob(f"{prefix}{MANIFEST_NAME}")
+    return str(blob.generation) if blob is not None else None
+
+def diff_remote(prefix, base_dir=None):
+    remote_files = list_remote_files(prefix)
+    base_manifest = read_local_manifest(base_dir) if base_dir else {}
+    changed = [
+        path for path, entry in remote_files.items()
+        if base_manifest.get(path, {}).get("md5") != entry.get("md5")
+        or not os.path.exists(os.path.join(base_dir, path))
+    ] if base_dir else list(remote_files)
+    removed = [path for path in base_manifest if path not in remote_files]
+    return remote_files, changed, removed
+
+def sync_down(prefix, target_dir, base_dir=None, workers: int = SYNC_WORKERS, attempts: int = SYNC_DOWN_ATTEMPTS):
+    # Builds target_dir from base_dir plus whatever changed in GCS. Returns None,
+    # without creating target_dir, when base_dir is already current. target_dir
+    # is expected to be an unpublished index version, so a partial download is
+    # never visible to readers. Every file is fetched at the generation the
+    # manifest names; if a concurrent sync_up removed or replaced one
+    # meanwhile, the download starts over from the new manifest.
+    for attempt in range(1, attempts + 1):
+        try:
+            return _sync_down_once(prefix, target_dir, base_dir, workers)
+        except (NotFound, PreconditionFailed) as e:
+            shutil.rmtree(target_dir, ignore_errors=True)
+            if attempt == attempts:
+                raise
+            logger.warning(f"gs://{get_bucket().name}/{prefix} changed during download, retrying: {str(e)}")
+
+def _sync_down_once(prefix, target_dir, base_dir, workers):
+    remote_files, changed, removed = diff_remote(prefix, base_dir)
+    if base_dir and not changed and not removed:
+        logger.info(f"Local copy at {base_dir} is current with gs://{get_bucket().name}/{prefix}")
+        return None
+
+    os.makedirs(target_dir)
+    for path in remote_files:
+        if path not in changed:
+            destination = os.path.join(target_dir, path)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copy2(os.path.join(base_dir, path), destination)
+
+    def download(relative_path):
+        local_path = os.path.join(target_dir, relative_path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        entry = remote_files[relative_path]
+        generation = entry.get("generation")
+        get_bucket().blob(f"{prefix}{object_name(relative_path, entry)}").download_to_filename(local_path, if_generation_match=int(generation) if generation else None)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(download, changed))
+    write_local_manifest(target_dir, remote_files)
+
+    logger.info(f"Synced gs://{get_bucket().name}/{prefix} to {target_dir}: {len(changed)} downloaded, {len(remote_files) - len(changed)} unchanged")
+    return len(changed)
+
+def read_snapshot_generation(local_dir):
+    path = os.path.join(local_dir, SNAPSHOT_GENERATION_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip() or None
+
+def publish_snapshot(local_dir, blob_name, manifest_generation=None, exclude=()):
+    # One compressed artifact of the whole directory, including the local sync
+    # manifest so instances restored from it can take delta syncs afterwards.
+    # manifest_generation names the synced file set the snapshot matches.
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".tar.gz") as temp_file:
+        temp_path = temp_file.name
+    try:
+        with tarfile.open(temp_path, "w:gz") as archive:
+            for name in sorted(os.listdir(local_dir)):
+                if name != SNAPSHOT_GENERATION_NAME and name not in exclude:
+                    archive.add(os.path.join(local_dir, name), arcname=name)
+        blob = get_bucket().blob(blob_name)
+        if manifest_generation is not None:
+            blob.metadata = {SNAPSHOT_MANIFEST_KEY: manifest_generation}
+        blob.upload_from_filename(temp_path, content_type="application/gzip")
+    finally:
+        os.unlink(temp_path)
+    with open(os.path.join(local_dir, SNAPSHOT_GENERATION_NAME), "w") as f:
+        f.write(str(blob.generation))
+    logger.info(f"Published snapshot of {local_dir} to gs://{get_bucket().name}/{blob_name} (generation {blob.generation})")
+    return blob.generation
+
+def remote_snapshot(blob_name):
+    # (generation, manifest generation it was taken with); (None, None) if absent
+    blob = get_bucket().get_blob(blob_name)
+    if blob is None:
+        return None, None
+    return str(blob.generation), (blob.metadata or {}).get(SNAPSHOT_MANIFEST_KEY)
+
+def restore_snapshot(blob_name, target_dir, generation):
+    # Extracts the given snapshot generation into a new target_dir
+    os.makedirs(target_dir)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".tar.gz") as temp_file:
+        temp_path = temp_file.name
+    try:
+        get_bucket().blob(blob_name).download_to_filename(temp_path, if_generation_match=int(generation))
+        with tarfile.open(temp_path, "r:gz") as archive:
+            archive.extractall(target_dir, filter="data")
+        with open(os.path.join(target_dir, SNAPSHOT_GENERATION_NAME), "w") as f:
+            f.write(generation)
+    finally:
+        os.unlink(temp_path)
+
+    logger.info(f"Restored {target_dir} from snapshot generation {generation}")
@@ -0,0 +1,103 @@
+import os
+import logging
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "3.05"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT_SECONDS", "30"))
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+RETRY_TOTAL = int(os.getenv("HTTP_RETRY_TOTAL", "3"))
+RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF_SECONDS", "0.25"))
+RETRY_JITTER = float(os.getenv("HTTP_RETRY_JITTER_SECONDS", "0.25"))
+HEDGE_DELAY = float(os.getenv("HTTP_HEDGE_DELAY_SECONDS", "0")) or None
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def build_session(retries: int, pool_size: int = POOL_SIZE):
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        status_forcelist=RETRY_STATUSES,
+        # Callers opt in per request, so POST is allowed here
+        allowed_methods=frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS", "POST"}),
+        backoff_factor=RETRY_BACKOFF,
+        backoff_jitter=RETRY_JITTER,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+class HTTPClient:
+    # Keep-alive connection pools with connect/read timeouts on every call.
+    # Requests marked idempotent go through a session that retries connection
+    # errors and retryable statuses with jittered exponential backoff. With
+    # hedge=True a second identical request is sent if the first has not
+    # answered within hedge_delay, and whichever succeeds first is returned.
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), retries: int = RETRY_TOTAL, hedge_delay: float | None = HEDGE_DELAY, pool_size: int = POOL_SIZE):
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self._session = build_session(0, pool_size)
+        self._retrying_session = build_session(retries, pool_size)
+        self._hedge_executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="http-hedge")
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "hedges": 0, "hedge_wins": 0}
+
+    def request(self, method, url, idempotent: bool = False, hedge: bool = False, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        session = self._retrying_session if idempotent else self._session
+        with self._stats_lock:
+            self._stats["requests"] += 1
+        if hedge and idempotent and self.hedge_delay:
+            return self._hedged(lambda: session.request(method, url, **kwargs))
+        return session.request(method, url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, idempotent=True, **kwargs)
+
+    def _hedged(self, send):
+        primary = self._hedge_executor.submit(send)
+        done, _ = wait([primary], timeout=self.hedge_delay)
+        if done:
+            return primary.result()
+
+        with self._stats_lock:
+            self._stats["hedges"] += 1
+        hedge = self._hedge_executor.submit(send)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                if future is hedge:
+                    with self._stats_lock:
+                        self._stats["hedge_wins"] += 1
+                return response
+        raise error
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+@lru_cache(maxsize=1)
+def get_http_client():
+    return HTTPClient()
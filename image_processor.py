@@ -0,0 +1,85 @@
+import os
+import hashlib
+import logging
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from dataclasses import dataclass
+from PIL import Image, ImageOps
+from pillow_heif import register_heif_opener
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+register_heif_opener()
+
+# Llama 3.2 Vision tiles images at 560px and accepts up to 1120x1120
+MAX_IMAGE_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1120"))
+JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+UPLOADED_CACHE_SIZE = 4096
+
+@dataclass(frozen=True)
+class PreparedImage:
+    data: bytes
+    sha256: str
+    width: int
+    height: int
+    content_type: str = "image/jpeg"
+    extension: str = "jpg"
+
+def prepare_image(raw: bytes, max_side: int = MAX_IMAGE_SIDE, quality: int = JPEG_QUALITY):
+    # Decodes once (HEIC included), applies the EXIF rotation, downscales to
+    # max_side and re-encodes as JPEG. The hash is of the re-encoded bytes, so
+    # the same photo uploaded twice maps to the same object.
+    with Image.open(BytesIO(raw)) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+
+        output = BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+        data = output.getvalue()
+        return PreparedImage(data=data, sha256=hashlib.sha256(data).hexdigest(), width=image.width, height=image.height)
+
+class UploadedImageCache:
+    # Content hashes already known to exist in the bucket, so repeat uploads
+    # skip both the existence check and the upload.
+    def __init__(self, max_size: int = UPLOADED_CACHE_SIZE):
+        self.max_size = max_size
+        self._hashes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, sha256):
+        with self._lock:
+            if sha256 in self._hashes:
+                self._hashes.move_to_end(sha256)
+                return True
+            return False
+
+    def add(self, sha256):
+        with self._lock:
+            self._hashes[sha256] = True
+            self._hashes.move_to_end(sha256)
+            while len(self._hashes) > self.max_size:
+                self._hashes.popitem(last=False)
+
+uploaded_images = UploadedImageCache()
+
+def upload_prepared_image(bucket, prepared: PreparedImage, prefix: str = "uploads/images/"):
+    blob = bucket.blob(f"{prefix}{prepared.sha256}.{prepared.extension}")
+    if prepared.sha256 in uploaded_images:
+        logger.info(f"Image {prepared.sha256[:12]} already uploaded, reusing it")
+    elif blob.exists():
+        uploaded_images.add(prepared.sha256)
+        logger.info(f"Image {prepared.sha256[:12]} found in bucket, skipping upload")
+    else:
+        blob.upload_from_string(prepared.data, content_type=prepared.content_type)
+        uploaded_images.add(prepared.sha256)
+        logger.info(f"Uploaded image {prepared.sha256[:12]} ({prepared.width}x{prepared.height}, {len(prepared.data)} bytes)")
+    return f"gs://{bucket.name}/{blob.name}", blob.public_url
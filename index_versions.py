@@ -0,0 +1,92 @@
+import os
+import time
+import fcntl
+import shutil
+import logging
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Local layout:
+#   chroma_db/versions/v<ns>/  one complete Chroma directory per version
+#   chroma_db/CURRENT          name of the published version
+#   chroma_db/writer.lock      flock()ed by whichever process is building a version
+# Readers open whatever CURRENT names and keep that directory for as long as
+# they hold the store; writers only ever mutate an unpublished copy.
+
+KEEP_VERSIONS = int(os.getenv("INDEX_KEEP_VERSIONS", "2"))
+
+def set_index_root(path):
+    # Absolute, so the layout does not move if the working directory changes
+    global INDEX_ROOT, VERSIONS_DIR, CURRENT_FILE, WRITER_LOCK_FILE
+    INDEX_ROOT = os.path.abspath(path)
+    VERSIONS_DIR = os.path.join(INDEX_ROOT, "versions")
+    CURRENT_FILE = os.path.join(INDEX_ROOT, "CURRENT")
+    WRITER_LOCK_FILE = os.path.join(INDEX_ROOT, "writer.lock")
+
+set_index_root(os.getenv("INDEX_ROOT", "chroma_db"))
+
+@contextmanager
+def writer_lock():
+    # Advisory lock shared by every process on this disk; released by the OS if
+    # the holder dies. Everything that creates versions holds it, so the layout
+    # is created here on first use.
+    os.makedirs(VERSIONS_DIR, exist_ok=True)
+    with open(WRITER_LOCK_FILE, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def current_version_dir():
+    try:
+        with open(CURRENT_FILE) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    path = os.path.join(VERSIONS_DIR, name)
+    return path if name and os.path.isdir(path) else None
+
+def new_version_dir():
+    return os.path.join(VERSIONS_DIR, f"v{time.time_ns():020d}")
+
+def clone_version(source_dir, target_dir):
+    # A real copy, not hard links: the clone's sqlite file is written to while
+    # the source is still being served.
+    if source_dir is None:
+        os.makedirs(target_dir)
+    else:
+        shutil.copytree(source_dir, target_dir)
+    return target_dir
+
+def publish_version(version_dir):
+    temp_path = f"{CURRENT_FILE}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(os.path.basename(version_dir))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, CURRENT_FILE)
+    logger.info(f"Published index version {os.path.basename(version_dir)}")
+
+def discard_version(version_dir):
+    shutil.rmtree(version_dir, ignore_errors=True)
+    logger.info(f"Discarded index version {os.path.basename(version_dir)}")
+
+def collect_garbage(in_use=(), keep: int = KEEP_VERSIONS):
+    # Call with the writer lock held. Keeps the published version, the
+    # keep - 1 versions published before it and anything the caller still has
+    # open. Versions newer than the published one can only be left over from a
+    # writer that died, since nobody else holds the lock.
+    current = current_version_dir()
+    protected = {os.path.abspath(path) for path in in_use if path}
+    versions = sorted(os.listdir(VERSIONS_DIR))
+    if current:
+        current_name = os.path.basename(current)
+        older = [name for name in versions if name <= current_name]
+        protected.update(os.path.abspath(os.path.join(VERSIONS_DIR, name)) for name in older[-keep:])
+    for name in versions:
+        path = os.path.join(VERSIONS_DIR, name)
+        if os.path.abspath(path) not in protected:
+            discard_version(path)
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import uuid
+import logging
+import argparse
+import threading
+from dataclasses import dataclass, replace
+from gcs_client import get_bucket
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from pdf_processor import process_new_pdfs
+from metrics import start_metrics_server
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DATA_PATH = "pdf/new/"
+POLL_INTERVAL_SECONDS = int(os.getenv("INGESTION_POLL_SECONDS", "300"))
+LEASE_BLOB = "ingestion/lease.json"
+LEASE_SECONDS = int(os.getenv("INGESTION_LEASE_SECONDS", "7200"))
+
+@dataclass(frozen=True)
+class IngestionStatus:
+    running: bool = False
+    pending_files: int = 0
+    last_checked: float | None = None
+    last_finished: float | None = None
+    last_processed_count: int = 0
+    total_processed: int = 0
+    last_error: str | None = None
+
+def count_pending_pdfs():
+    return sum(1 for blob in get_bucket().list_blobs(prefix=DATA_PATH) if blob.name.lower().endswith('.pdf'))
+
+def acquire_lease(holder, ttl=LEASE_SECONDS):
+    # One ingestion run at a time across instances. The lease object is created
+    # with if_generation_match=0; a lease past its expiry (its holder died) is
+    # taken over by matching its generation. Returns the generation of the
+    # lease now held, or None if another instance holds it.
+    bucket = get_bucket()
+    expected = 0
+    existing = bucket.get_blob(LEASE_BLOB)
+    if existing is not None:
+        try:
+            lease = json.loads(existing.download_as_string(if_generation_match=existing.generation))
+        except (NotFound, PreconditionFailed):
+            return None
+        if lease["expires"] > time.time():
+            return None
+        logger.warning(f"Taking over expired ingestion lease held by {lease['holder']}")
+        expected = existing.generation
+    blob = bucket.blob(LEASE_BLOB)
+    try:
+        blob.upload_from_string(json.dumps({"holder": holder, "expires": time.time() + ttl}),
+                                content_type="application/json", if_generation_match=expected)
+    except PreconditionFailed:
+        return None
+    return blob.generation
+
+def release_lease(generation):
+    try:
+        get_bucket().blob(LEASE_BLOB).delete(if_generation_match=generation)
+    except (NotFound, PreconditionFailed):
+        pass
+
+class IngestionWorker:
+    def __init__(self, poll_interval=POLL_INTERVAL_SECONDS):
+        self.poll_interval = poll_interval
+        self._holder = f"{os.uname().nodename}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._status = IngestionStatus()
+        self._status_lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def status(self):
+        with self._status_lock:
+            return self._status
+
+    def _update_status(self, **changes):
+        with self._status_lock:
+            self._status = replace(self._status, **changes)
+
+    def run_once(self):
+        with self._run_lock:
+            try:
+                pending = count_pending_pdfs()
+                self._update_status(pending_files=pending, last_checked=time.time())
+                if not pending:
+                    return 0
+
+                lease = acquire_lease(self._holder)
+                if lease is None:
+                    logger.info(f"Found {pending} new PDF(s), but another instance is ingesting")
+                    return 0
+                try:
+                    logger.info(f"Found {pending} new PDF(s), starting ingestion")
+                    self._update_status(running=True)
+                    processed_count = process_new_pdfs()
+                finally:
+                    release_lease(lease)
+                status = self.status()
+                self._update_status(
+                    running=False,
+                    pending_files=0,
+                    last_finished=time.time(),
+                    last_processed_count=processed_count,
+                    total_processed=status.total_processed + processed_count,
+                    last_error=None,
+                )
+                logger.info(f"Ingestion finished, processed {processed_count} PDF(s)")
+                return processed_count
+            except Exception as e:
+                logger.error(f"PDF ingestion error: {str(e)}", exc_info=True)
+                self._update_status(running=False, last_finished=time.time(), last_error=str(e))
+                return 0
+
+    def trigger(self):
+        self._wake.set()
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            self.run_once()
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run_forever, name="pdf-ingestion", daemon=True)
+            self._thread.start()
+            logger.info(f"Started ingestion worker, polling every {self.poll_interval}s")
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Poll GCS for new PDFs and ingest them into the vector store.")
+    parser.add_argument("--once", action="store_true", help="Run a single ingestion pass and exit")
+    parser.add_argument("--interval", type=int, default=POLL_INTERVAL_SECONDS, help="Seconds between polls")
+    args = parser.parse_args()
+
+    worker = IngestionWorker(poll_interval=args.interval)
+    if args.once:
+        worker.run_once()
+    else:
+        start_metrics_server()
+        worker.run_forever()
@@ -0,0 +1,107 @@
+import os
+import re
+import math
+import json
+import heapq
+import logging
+import threading
+from collections import Counter, defaultdict
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Keeps hyphenated and alphanumeric tokens whole so shade codes such as
+# "nc-20" or "2n1" match exactly.
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-'][a-z0-9]+)*")
+
+def tokenize(text: str):
+    return TOKEN_PATTERN.findall(text.lower())
+
+class BM25Index:
+    # Incremental Okapi BM25 over chunk IDs. Documents can be added or replaced
+    # one batch at a time, and the whole index round-trips through a JSON file
+    # kept inside the Chroma directory so it is synced together with the DB.
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._texts = {}
+        self._lengths = {}
+        self._postings = defaultdict(dict)
+        self._total_length = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._texts)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._texts
+
+    def get_text(self, doc_id):
+        return self._texts.get(doc_id)
+
+    def remove(self, ids):
+        with self._lock:
+            for doc_id in ids:
+                text = self._texts.pop(doc_id, None)
+                if text is None:
+                    continue
+                self._total_length -= self._lengths.pop(doc_id)
+                for term in set(tokenize(text)):
+                    postings = self._postings.get(term)
+                    if postings is not None:
+                        postings.pop(doc_id, None)
+                        if not postings:
+                            del self._postings[term]
+
+    def add(self, ids, texts):
+        with self._lock:
+            self.remove([doc_id for doc_id in ids if doc_id in self._texts])
+            for doc_id, text in zip(ids, texts):
+                terms = tokenize(text)
+                self._texts[doc_id] = text
+                self._lengths[doc_id] = len(terms)
+                self._total_length += len(terms)
+                for term, frequency in Counter(terms).items():
+                    self._postings[term][doc_id] = frequency
+
+    def search(self, query: str, k: int = 3):
+        with self._lock:
+            doc_count = len(self._texts)
+            if not doc_count:
+                return []
+            average_length = self._total_length / doc_count or 1.0
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, frequency in postings.items():
+                    length_norm = 1 - self.b + self.b * self._lengths[doc_id] / average_length
+                    scores[doc_id] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+            return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def save(self, path: str):
+        with self._lock:
+            data = {"k1": self.k1, "b": self.b, "documents": self._texts}
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as f:
+            data = json.load(f)
+        index = cls(k1=data.get("k1", 1.5), b=data.get("b", 0.75))
+        documents = data.get("documents", {})
+        index.add(list(documents.keys()), list(documents.values()))
+        return index
+
+def reciprocal_rank_fusion(rankings, k: int = 60):
+    # rankings: lists of IDs, best first. Returns IDs ordered by fused score.
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] += 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
@@ -1,10 +1,15 @@
 import os
 import logging
+import threading
+import httpx
 import openai
+from datetime import datetime, timedelta, timezone
 import streamlit as st
 from google.auth.transport import requests
 from google.auth import default
 from dotenv import load_dotenv
+from prompt_builder import build_prompt_parts, fold_summary_ahead
+from metrics import timed
 # from google.cloud import aiplatform
 
 load_dotenv()
@@ -28,22 +33,99 @@ MAAS_ENDPOINT = os.getenv("MAAS_ENDPOINT")
 PROJECT_NUMBER = os.getenv("PROJECT_NUMBER")
 SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
 
-def get_openai_client(is_image_model=False):
-    credentials, _ = default(scopes=SCOPES)
-    auth_request = requests.Request()
-    credentials.refresh(auth_request)
-    
+TOKEN_REFRESH_MARGIN = timedelta(minutes=int(os.getenv("TOKEN_REFRESH_MARGIN_MINUTES", "5")))
+HTTP_MAX_CONNECTIONS = int(os.getenv("MAAS_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("MAAS_MAX_KEEPALIVE_CONNECTIONS", "10"))
+
+def build_base_url(is_image_model=False):
     endpoint = "openapi" if is_image_model else "openapi/chat/completions"
     base_url = f"https://{MAAS_ENDPOINT}/v1beta1/projects/{PROJECT_NUMBER}/locations/us-central1/endpoints/{endpoint}"
     
     if not is_image_model:
         base_url += "?"
-    
-    return openai.OpenAI(
-        base_url=base_url,
-        api_key=credentials.token
-    )
+    return base_url
+
+class OpenAIClientRegistry:
+    # One set of credentials and one HTTP connection pool per process, shared by
+    # the text and image clients. Clients are rebuilt only when the token changes.
+    def __init__(self, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._http_client = None
+        self._clients = {}
+        self._stats = {"token_refreshes": 0, "client_builds": 0}
+
+    def _token_is_fresh(self):
+        credentials = self._credentials
+        if credentials is None or not credentials.token:
+            return False
+        if credentials.expiry is None:
+            return True
+        # google-auth stores expiry as a naive UTC datetime
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return credentials.expiry - self.refresh_margin > now
+
+    @timed("llm.token_refresh")
+    def _refresh_token(self):
+        if self._credentials is None:
+            self._credentials, _ = default(scopes=SCOPES)
+        self._credentials.refresh(requests.Request())
+        self._stats["token_refreshes"] += 1
+        logger.info(f"Refreshed MaaS access token, expires at {self._credentials.expiry}")
+
+    def _get_http_client(self):
+        if self._http_client is None:
+            self._http_client = openai.DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                )
+            )
+        return self._http_client
+
+    def get_client(self, is_image_model=False):
+        if self._token_is_fresh():
+            entry = self._clients.get(is_image_model)
+            if entry is not None and entry[0] == self._credentials.token:
+                return entry[1]
+
+        with self._lock:
+            if not self._token_is_fresh():
+                self._refresh_token()
+            token = self._credentials.token
+            entry = self._clients.get(is_image_model)
+            if entry is None or entry[0] != token:
+                client = openai.OpenAI(
+                    base_url=build_base_url(is_image_model),
+                    api_key=token,
+                    http_client=self._get_http_client(),
+                )
+                self._clients[is_image_model] = (token, client)
+                self._stats["client_builds"] += 1
+                entry = self._clients[is_image_model]
+            return entry[1]
 
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+_client_registry = OpenAIClientRegistry()
+_client_override = None
+
+def get_openai_client(is_image_model=False):
+    if _client_override is not None:
+        return _client_override
+    return _client_registry.get_client(is_image_model)
+
+def set_openai_client(client):
+    # Sends text and image requests through one client instead of MaaS, e.g.
+    # a local stand-in for benchmarks. None restores the MaaS clients.
+    global _client_override
+    _client_override = client
+
+def get_client_stats():
+    return _client_registry.stats()
 
 # SYSTEM_PROMPT = """<|begin_of_text|><|start_header_id|>system<|end_header_id|>
 # You are a makeup artist and beauty advisor named Aiysha. You apply cosmetics on clients to enhance features, create looks and styles according to the latest trends in beauty and fashion. 
@@ -102,30 +184,106 @@ def get_openai_client(is_image_model=False):
 #     else:
 #         return "I'm sorry, I couldn't generate a response. Please try again."
 
-def get_text_response(message: str, context: str, chat_history: list):
-    client = get_openai_client(is_image_model=False)
-    
-    system_message = """
+TEXT_MODEL = "meta/llama-3.1-405b-instruct-maas"
+IMAGE_MODEL = "meta/llama-3.2-90b-vision-instruct-maas"
+
+TEXT_SYSTEM_MESSAGE = """
     You are a makeup artist and beauty advisor named Aiysha. You apply cosmetics on clients to enhance features, create looks and styles according to the latest trends in beauty and fashion. 
     You offer advice about skincare routines, know how to work with different textures of skin tone, and are able to use both traditional methods and new techniques for applying products. 
     Please respond with complete sentences and keep your responses under 280 characters.
     """
-    
+
+IMAGE_SYSTEM_MESSAGE = """ 
+    You are a makeup artist and beauty advisor named Aiysha. 
+    You apply cosmetics on clients to enhance features, create looks and styles according to the latest trends in beauty and fashion. 
+    You offer advice about skincare routines, know how to work with different textures of skin tone, and are able to use both traditional methods and new techniques for applying products.
+    Analyze the image and answer the question based on your expertise and context provided.
+    """
+
+TEXT_EMPTY_RESPONSE = "I'm sorry, I couldn't generate a response. Could you please try rephrasing your question?"
+TEXT_ERROR_RESPONSE = "I apologize, but I encountered an error while processing your request. Please try again."
+IMAGE_EMPTY_RESPONSE = "I'm sorry, I couldn't generate a response based on the image. Could you please try rephrasing your question or uploading a different image?"
+IMAGE_ERROR_RESPONSE = "I apologize, but I encountered an error while processing the image. Please try again or consider using a different image."
+
+SUMMARY_SYSTEM_MESSAGE = """
+    You maintain a running summary of a conversation between a user and Aiysha, a beauty advisor.
+    Update the existing summary with the new turns. Keep the user's stated skin type, tone, preferences, products and open questions.
+    Respond with the updated summary only, in under 120 words.
+    """
+
+@timed("llm.summary")
+def summarize_conversation(previous_summary: str, turns: list):
+    client = get_openai_client(is_image_model=False)
+    transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+    try:
+        response = client.chat.completions.create(
+            model=TEXT_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_SYSTEM_MESSAGE},
+                {"role": "user", "content": f"Existing summary: {previous_summary or 'None'}\n\nNew turns:\n{transcript}"},
+            ],
+            max_tokens=256,
+        )
+        summary = response.choices[0].message.content if response.choices else None
+        if summary:
+            return summary.strip()
+        logger.warning("Empty response from summary model")
+    except Exception as e:
+        logger.error(f"Error in conversation summarization: {str(e)}")
+    # Fall back to a truncated transcript so older turns are not silently lost
+    return f"{previous_summary}\n{transcript}".strip()[-2000:]
+
+def prefetch_conversation_summary(chat_history: list):
+    # Run after a turn, off the script thread; the next prompt reads the result from cache
+    fold_summary_ahead(chat_history, summarize_conversation)
+
+def build_text_messages(message: str, context: str, chat_history: list):
+    summary, recent, context = build_prompt_parts(message, context, chat_history, fixed_text=TEXT_SYSTEM_MESSAGE)
+    system_message = TEXT_SYSTEM_MESSAGE
+    if summary:
+        system_message += f"\n    Summary of the earlier conversation: {summary}\n"
     messages = [
         {"role": "system", "content": system_message},
     ]
 
-    for turn in chat_history:
+    for turn in recent:
         messages.append({"role": turn["role"], "content": turn["content"]})
 
     messages.append({
         "role": "user", 
         "content": f"Context: {context}\n\nQuestion: {message}"
     })
+    return messages
+
+def build_image_messages(message: str, image_url: str, context: str, chat_history: list):
+    # Earlier turns only ever contribute their text; the image is sent once, with this question
+    summary, recent, context = build_prompt_parts(message, context, chat_history, fixed_text=IMAGE_SYSTEM_MESSAGE)
+    question = f"Context: {context}\n\nQuestion: {message}"
+    if summary:
+        question = f"Summary of the earlier conversation: {summary}\n\n{question}"
+    messages = [
+        {
+            "role": "user", 
+            "content": [
+                {"image_url": {"url": image_url}, "type": "image_url"},
+                {"text": question, "type": "text"},
+            ]
+        },
+        {"role": "assistant", "content": IMAGE_SYSTEM_MESSAGE},
+    ]
+
+    for turn in recent:
+        messages.append({"role": turn["role"], "content": turn["content"]})
+    return messages
+
+@timed("llm.text")
+def get_text_response(message: str, context: str, chat_history: list):
+    client = get_openai_client(is_image_model=False)
+    messages = build_text_messages(message, context, chat_history)
     
     try:
         response = client.chat.completions.create(
-            model="meta/llama-3.1-405b-instruct-maas",
+            model=TEXT_MODEL,
             messages=messages,
             max_tokens=4096,
         )
@@ -136,39 +294,20 @@ def get_text_response(message: str, context: str, chat_history: list):
             return generated_content
         else:
             logger.warning("Empty response from text model")
-            return "I'm sorry, I couldn't generate a response. Could you please try rephrasing your question?"
+            return TEXT_EMPTY_RESPONSE
     
     except Exception as e:
         logger.error(f"Error in text response generation: {str(e)}")
-        return "I apologize, but I encountered an error while processing your request. Please try again."
+        return TEXT_ERROR_RESPONSE
     
+@timed("llm.image")
 def get_image_response(message: str, image_url: str, context: str, chat_history: list):
     client = get_openai_client(is_image_model=True)
-    
-    system_message = """ 
-    You are a makeup artist and beauty advisor named Aiysha. 
-    You apply cosmetics on clients to enhance features, create looks and styles according to the latest trends in beauty and fashion. 
-    You offer advice about skincare routines, know how to work with different textures of skin tone, and are able to use both traditional methods and new techniques for applying products.
-    Analyze the image and answer the question based on your expertise and context provided.
-    """
-    
-    messages = [
-        {
-            "role": "user", 
-            "content": [
-                {"image_url": {"url": image_url}, "type": "image_url"},
-                {"text": f"Context: {context}\n\nQuestion: {message}", "type": "text"},
-            ]
-        },
-        {"role": "assistant", "content": system_message},
-    ]
-
-    for turn in chat_history:
-        messages.append({"role": turn["role"], "content": turn["content"]})
+    messages = build_image_messages(message, image_url, context, chat_history)
     
     try:
         response = client.chat.completions.create(
-            model="meta/llama-3.2-90b-vision-instruct-maas",
+            model=IMAGE_MODEL,
             messages=messages,
             max_tokens=4096,
         )
@@ -179,8 +318,49 @@ def get_image_response(message: str, image_url: str, context: str, chat_history:
             return generated_content
         else:
             logger.warning("Empty response from image model")
-            return "I'm sorry, I couldn't generate a response based on the image. Could you please try rephrasing your question or uploading a different image?"
+            return IMAGE_EMPTY_RESPONSE
     
     except Exception as e:
         logger.error(f"Error in image response generation: {str(e)}")
-        return "I apologize, but I encountered an error while processing the image. Please try again or consider using a different image."
\ No newline at end of file
+        return IMAGE_ERROR_RESPONSE
+
+def _stream_completion(client, model: str, messages: list, empty_response: str, error_response: str, label: str):
+    # Yields content deltas as they arrive. If the model produced nothing, or failed
+    # before the first delta, the usual fallback message is yielded instead so the
+    # caller always ends up with displayable text. A failure after the first delta
+    # is re-raised: the answer is incomplete and must not pass for a finished one.
+    produced = False
+    try:
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=4096,
+            stream=True,
+        )
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                produced = True
+                yield delta
+        if not produced:
+            logger.warning(f"Empty response from {label} model")
+            yield empty_response
+    except Exception as e:
+        logger.error(f"Error in {label} response streaming: {str(e)}")
+        if produced:
+            raise
+        yield error_response
+
+@timed("llm.text_stream")
+def stream_text_response(message: str, context: str, chat_history: list):
+    client = get_openai_client(is_image_model=False)
+    messages = build_text_messages(message, context, chat_history)
+    yield from _stream_completion(client, TEXT_MODEL, messages, TEXT_EMPTY_RESPONSE, TEXT_ERROR_RESPONSE, "text")
+
+@timed("llm.image_stream")
+def stream_image_response(message: str, image_url: str, context: str, chat_history: list):
+    client = get_openai_client(is_image_model=True)
+    messages = build_image_messages(message, image_url, context, chat_history)
+    yield from _stream_completion(client, IMAGE_MODEL, messages, IMAGE_EMPTY_RESPONSE, IMAGE_ERROR_RESPONSE, "image")
@@ -0,0 +1,84 @@
+import os
+import time
+import uuid
+import inspect
+import logging
+import contextvars
+from functools import wraps, lru_cache
+from contextlib import contextmanager
+from prometheus_client import Counter, Histogram, start_http_server
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+STAGE_SECONDS = Histogram("aiysha_stage_seconds", "Time spent in each stage", ["stage"], buckets=LATENCY_BUCKETS)
+STAGE_ERRORS = Counter("aiysha_stage_errors_total", "Stages that raised", ["stage"])
+INGEST_CHUNKS = Counter("aiysha_ingest_chunks_total", "Chunks produced at ingestion, by outcome", ["outcome"])
+EMBEDDING_BATCH_SIZES = Histogram("aiysha_embedding_batch_size", "Queries embedded per batched call", buckets=(1, 2, 4, 8, 16, 32, 64))
+
+trace_id_var = contextvars.ContextVar("trace_id", default=None)
+
+def new_trace_id():
+    trace_id = uuid.uuid4().hex[:16]
+    trace_id_var.set(trace_id)
+    return trace_id
+
+def current_trace_id():
+    return trace_id_var.get()
+
+def observe(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    logger.debug(f"[{current_trace_id() or '-'}] {stage} took {seconds * 1000:.1f} ms")
+
+@contextmanager
+def span(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def timed(stage: str):
+    # Decorator form of span. Generator functions are timed until exhausted
+    # (or closed), and the delay to their first item is recorded as
+    # <stage>.first_chunk.
+    def decorator(fn):
+        if inspect.isgeneratorfunction(fn):
+            @wraps(fn)
+            def generator_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                first = True
+                with span(stage):
+                    for item in fn(*args, **kwargs):
+                        if first:
+                            observe(f"{stage}.first_chunk", time.perf_counter() - start)
+                            first = False
+                        yield item
+            return generator_wrapper
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@lru_cache(maxsize=1)
+def start_metrics_server(port: int = METRICS_PORT):
+    # Serves /metrics in Prometheus format on a side port, once per process.
+    # Port 0 disables it.
+    if not port:
+        return None
+    try:
+        start_http_server(port)
+        logger.info(f"Serving Prometheus metrics on port {port}")
+        return port
+    except OSError as e:
+        logger.error(f"Could not start metrics server on port {port}: {str(e)}")
+        return None
@@ -0,0 +1,11 @@
+from langchain_community.document_loaders.pdf import PyPDFLoader
+
+# Kept free of GCS and vector store imports so worker processes started with
+# the "spawn" method only pay for the PDF loader when they import this module.
+
+def parse_pdf(path: str, source: str):
+    loader = PyPDFLoader(path)
+    pdf_documents = loader.load()
+    for doc in pdf_documents:
+        doc.metadata["source"] = source
+    return pdf_documents
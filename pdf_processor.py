@@ -1,65 +1,155 @@
 import os
 import logging
 import tempfile
-from google.cloud import storage
-from langchain_community.document_loaders.pdf import PyPDFLoader
+import multiprocessing
+from contextlib import ExitStack
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from gcs_client import get_bucket
+from google.api_core.exceptions import PreconditionFailed
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain.schema.document import Document
-from vector_store import add_to_chroma
+from tokenizers import Tokenizer
+from vector_store import add_to_chroma, open_index_writer, get_duplicate_index, get_embedding_tokenizer, build_version_compact_index, EMBEDDING_MODEL, COMPACT_INDEX_MODE
+from chunk_dedupe import drop_duplicate_chunks
+from pdf_parser import parse_pdf
+from metrics import span, timed, INGEST_CHUNKS
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-BUCKET_NAME = "aiysha-convos"
 DATA_PATH = "pdf/new/"
+FAILED_PATH = "pdf/failed/"
 VECTORIZED_FILE = "pdf/processed/vectorized.txt"
+DOWNLOAD_WORKERS = int(os.getenv("PDF_DOWNLOAD_WORKERS", "8"))
+PARSE_WORKERS = int(os.getenv("PDF_PARSE_WORKERS", str(os.cpu_count() or 1)))
+MAX_FILES_IN_FLIGHT = int(os.getenv("PDF_MAX_FILES_IN_FLIGHT", str(PARSE_WORKERS + 1)))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+# bge-large reads at most 512 tokens; chunks are sized in its own tokens
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "256"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+# Files per published index version; 0 publishes once per run
+PUBLISH_EVERY_FILES = int(os.getenv("INGEST_PUBLISH_EVERY_FILES", "25"))
+# Times a group is rebuilt when another instance published to GCS first
+PUBLISH_ATTEMPTS = int(os.getenv("INGEST_PUBLISH_ATTEMPTS", "3"))
 
-storage_client = storage.Client()
-bucket = storage_client.bucket(BUCKET_NAME)
+@timed("ingest.list")
+def list_new_pdf_blobs():
+    return [blob for blob in get_bucket().list_blobs(prefix=DATA_PATH) if blob.name.lower().endswith('.pdf')]
 
-def load_documents():
-    documents = []
-    blobs = bucket.list_blobs(prefix=DATA_PATH)
-    for blob in blobs:
-        if blob.name.lower().endswith('.pdf'):
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
+@timed("ingest.download")
+def download_blob_to_temp(blob):
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_file:
+        temp_path = temp_file.name
+    try:
+        logger.info(f"Downloading blob: {blob.name}")
+        blob.download_to_filename(temp_path)
+    except Exception:
+        remove_temp_file(temp_path)
+        raise
+    return temp_path
+
+def remove_temp_file(path):
+    try:
+        os.unlink(path)
+    except Exception as e:
+        logger.error(f"Error deleting temporary file {path}: {str(e)}")
+
+def load_pdf(blob, parser):
+    # Returns the file's pages, [] for a file with nothing to ingest (empty,
+    # unparsable or without text). Download errors and a crashed parser pool
+    # are raised, leaving the file for the next run.
+    temp_path = download_blob_to_temp(blob)
+    try:
+        if os.path.getsize(temp_path) == 0:
+            logger.warning(f"Empty file downloaded: {blob.name}")
+            return []
+
+        logger.info(f"Loading PDF: {temp_path}")
+        try:
+            with span("ingest.parse"):
+                pdf_documents = parser.submit(parse_pdf, temp_path, blob.name).result()
+        except BrokenProcessPool:
+            raise
+        except Exception as e:
+            logger.error(f"Error parsing {blob.name}: {str(e)}")
+            return []
+        if not pdf_documents:
+            logger.warning(f"No content extracted from PDF: {blob.name}")
+        else:
+            logger.info(f"Successfully processed PDF: {blob.name}")
+        return pdf_documents
+    finally:
+        remove_temp_file(temp_path)
+
+def iter_pdf_documents(blobs, download_workers: int = DOWNLOAD_WORKERS, parse_workers: int = PARSE_WORKERS, max_in_flight: int = MAX_FILES_IN_FLIGHT):
+    # Yields (blob, pages) one file at a time as files finish loading, with
+    # pages None for a file that could not be loaded. At most max_in_flight
+    # files are downloaded or parsed ahead of the consumer, so memory stays
+    # bounded regardless of how many PDFs are waiting.
+    blobs = iter(blobs)
+    mp_context = multiprocessing.get_context("spawn")
+    with ThreadPoolExecutor(max_workers=download_workers) as downloader, \
+            ProcessPoolExecutor(max_workers=parse_workers, mp_context=mp_context) as parser:
+        pending = {}
+
+        def submit_next():
+            blob = next(blobs, None)
+            if blob is not None:
+                pending[downloader.submit(load_pdf, blob, parser)] = blob
+            return blob is not None
+
+        while len(pending) < max_in_flight and submit_next():
+            pass
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                blob = pending.pop(future)
                 try:
-                    logger.info(f"Downloading blob: {blob.name}")
-                    blob.download_to_filename(temp_file.name)
-                    
-                    if os.path.getsize(temp_file.name) == 0:
-                        logger.warning(f"Empty file downloaded: {blob.name}")
-                        continue
-                    
-                    logger.info(f"Loading PDF: {temp_file.name}")
-                    loader = PyPDFLoader(temp_file.name)
-                    pdf_documents = loader.load()
-                    
-                    if not pdf_documents:
-                        logger.warning(f"No content extracted from PDF: {blob.name}")
-                    else:
-                        for doc in pdf_documents:
-                            doc.metadata["source"] = blob.name
-                        documents.extend(pdf_documents)
-                        logger.info(f"Successfully processed PDF: {blob.name}")
-                
+                    pdf_documents = future.result()
                 except Exception as e:
-                    logger.error(f"Error processing {blob.name}: {str(e)}")
-                
-                finally:
-                    try:
-                        os.unlink(temp_file.name)
-                    except Exception as e:
-                        logger.error(f"Error deleting temporary file {temp_file.name}: {str(e)}")
-    
+                    logger.error(f"Error loading {blob.name}: {str(e)}")
+                    pdf_documents = None
+                submit_next()
+                yield blob, pdf_documents
+
+def load_documents(download_workers: int = DOWNLOAD_WORKERS, parse_workers: int = PARSE_WORKERS):
+    documents = []
+    for _, pdf_documents in iter_pdf_documents(list_new_pdf_blobs(), download_workers, parse_workers):
+        documents.extend(pdf_documents or [])
     logger.info(f"Total documents loaded: {len(documents)}")
     return documents
 
-def split_documents(documents: list[Document]):
+_token_length_override = None
+
+@lru_cache(maxsize=1)
+def get_token_length_function():
+    # Sizes chunks in the embedding model's tokens, with a copy of the tokenizer
+    # FastEmbed loaded from its local cache. There is no fallback: another
+    # length function would split every PDF differently from earlier runs, so
+    # ingestion fails instead and the PDFs stay in pdf/new/.
+    if _token_length_override is not None:
+        return _token_length_override
+    tokenizer = Tokenizer.from_str(get_embedding_tokenizer().to_str())
+    tokenizer.no_truncation()
+    tokenizer.no_padding()
+    logger.info(f"Sizing chunks with the {EMBEDDING_MODEL} tokenizer")
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+def set_token_length_function(length_function):
+    # Replaces the model tokenizer for chunk sizing, e.g. when benchmarks run
+    # with a fake embedding function
+    global _token_length_override
+    _token_length_override = length_function
+    get_token_length_function.cache_clear()
+
+def split_documents(documents: list[Document], chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS):
     text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=256,
-        chunk_overlap=25,
-        length_function=len,
+        chunk_size=chunk_tokens,
+        chunk_overlap=overlap_tokens,
+        length_function=get_token_length_function(),
         is_separator_regex=False,
     )
     return text_splitter.split_documents(documents)
@@ -80,55 +170,144 @@ def calculate_chunk_ids(chunks):
         chunk.metadata["id"] = chunk_id
     return chunks
 
-def process_new_pdfs():
-    documents = load_documents()
-    if not documents:
-        logger.info("No new documents to process.")
-        return 0
-    
-    chunks = split_documents(documents)
-    chunks_with_ids = calculate_chunk_ids(chunks)
-    add_to_chroma(chunks_with_ids)
-    
-    processed_files = set()
-    
+def read_vectorized_manifest():
     current_count = 0
     processed_pdfs = []
-    vectorized_blob = bucket.blob(VECTORIZED_FILE)
+    vectorized_blob = get_bucket().blob(VECTORIZED_FILE)
     if vectorized_blob.exists():
-        with tempfile.NamedTemporaryFile(mode='w+t', delete=False) as temp_file:
-            vectorized_blob.download_to_filename(temp_file.name)
-            with open(temp_file.name, 'r') as f:
-                lines = f.readlines()
-                if lines:
-                    current_count = int(lines[0].strip())
-                    processed_pdfs = [line.strip() for line in lines[1:]]
-            os.unlink(temp_file.name)
-    
-    unique_sources = set(doc.metadata.get("source") for doc in documents if doc.metadata.get("source"))
-    
-    for source in unique_sources:
-        if source.startswith(DATA_PATH):
+        lines = vectorized_blob.download_as_text().splitlines()
+        if lines:
+            current_count = int(lines[0].strip())
+            processed_pdfs = [line.strip() for line in lines[1:] if line.strip()]
+    return current_count, processed_pdfs
+
+def write_vectorized_manifest(count, processed_pdfs):
+    content = f"{count}\n" + "".join(f"{pdf}\n" for pdf in processed_pdfs)
+    get_bucket().blob(VECTORIZED_FILE).upload_from_string(content)
+
+def ingest_pdf(pdf_documents, writer):
+    # IDs are assigned before duplicates are dropped, so every surviving chunk
+    # keeps the ID it would have had anyway. Returns (kept, total) chunk counts.
+    with span("ingest.split"):
+        chunks = split_documents(pdf_documents)
+        chunks_with_ids = calculate_chunk_ids(chunks)
+    with span("ingest.near_duplicates"):
+        kept_chunks, dropped = drop_duplicate_chunks(chunks_with_ids, get_duplicate_index(writer.db))
+    INGEST_CHUNKS.labels("kept").inc(len(kept_chunks))
+    INGEST_CHUNKS.labels("exact_duplicate").inc(dropped["exact"])
+    INGEST_CHUNKS.labels("near_duplicate").inc(dropped["near"])
+    if dropped["exact"] or dropped["near"]:
+        logger.info(f"Dropped {dropped['exact']} exact and {dropped['near']} near-duplicate chunks of {len(chunks_with_ids)}")
+    sources = {document.metadata.get("source") for document in pdf_documents}
+    add_to_chroma(kept_chunks, batch_size=EMBED_BATCH_SIZE, writer=writer, replace_sources=sources)
+    return len(kept_chunks), len(chunks_with_ids)
+
+@timed("ingest.mark_processed")
+def mark_pdf_processed(source, current_count, processed_pdfs):
+    # Only called once the version holding the file's chunks is published,
+    # locally and in GCS, so a failure before this point leaves the PDF in
+    # pdf/new/ and the next run picks it up again; chunks whose stored text is
+    # unchanged are skipped on retry.
+    name = os.path.basename(source)
+    if name not in processed_pdfs:
+        processed_pdfs.append(name)
+        current_count += 1
+        write_vectorized_manifest(current_count, processed_pdfs)
+
+    blob = get_bucket().blob(source)
+    if blob.exists():
+        blob.delete()
+        logger.info(f"Processed and deleted file: {source}")
+    else:
+        logger.warning(f"File not found in bucket: {source}")
+    return current_count
+
+def move_to_failed(source):
+    # Files with nothing to ingest are set aside, so later runs neither
+    # download them again nor open an index version for them
+    bucket = get_bucket()
+    blob = bucket.blob(source)
+    bucket.copy_blob(blob, bucket, f"{FAILED_PATH}{os.path.basename(source)}")
+    blob.delete()
+    logger.warning(f"Moved {source} to {FAILED_PATH}")
+
+def ingest_group(blobs):
+    # Writes one group of files into one new index version, published (and
+    # uploaded to GCS) when the group is done; live queries keep reading the
+    # previous version meanwhile. The version is only cloned once a file in
+    # the group has pages to write.
+    # Returns (ingested sources, sources with nothing to ingest, kept chunks, total chunks).
+    ingested = []
+    failed = []
+    kept_chunks = 0
+    total_chunks = 0
+    with ExitStack() as stack:
+        writer = None
+        for blob, pdf_documents in iter_pdf_documents(blobs):
+            if pdf_documents is None:
+                continue
+            if not pdf_documents:
+                failed.append(blob.name)
+                continue
+            if writer is None:
+                writer = stack.enter_context(open_index_writer())
             try:
-                blob = bucket.blob(source)
-                if blob.exists():
-                    blob.delete()
-                    processed_files.add(source)
-                    processed_pdfs.append(os.path.basename(source))
-                    logger.info(f"Processed and deleted file: {source}")
-                else:
-                    logger.warning(f"File not found in bucket: {source}")
+                kept, total = ingest_pdf(pdf_documents, writer)
+                ingested.append(blob.name)
+                kept_chunks += kept
+                total_chunks += total
+                logger.info(f"Committed {kept} of {total} chunks from {blob.name}")
             except Exception as e:
-                logger.error(f"Error processing file {source}: {str(e)}")
-                
-    new_count = current_count + len(processed_files)
-    with tempfile.NamedTemporaryFile(mode='w+t', delete=False) as temp_file:
-        temp_file.write(f"{new_count}\n")
-        for pdf in processed_pdfs:
-            temp_file.write(f"{pdf}\n")
-        temp_file.flush()
-        vectorized_blob.upload_from_filename(temp_file.name)
-        os.unlink(temp_file.name)
-        
-    logger.info(f"Updated vectorized.txt with {len(processed_files)} new files. Total count: {new_count}")
-    return len(processed_files)
\ No newline at end of file
+                logger.error(f"Error processing file {blob.name}: {str(e)}", exc_info=True)
+
+        if writer is not None and writer.changed and COMPACT_INDEX_MODE != "off":
+            with span("ingest.compact_index"):
+                build_version_compact_index(writer.version_dir, writer.db)
+    return ingested, failed, kept_chunks, total_chunks
+
+@timed("ingest.run")
+def process_new_pdfs(publish_every: int = PUBLISH_EVERY_FILES, publish_attempts: int = PUBLISH_ATTEMPTS):
+    blobs = list_new_pdf_blobs()
+    if not blobs:
+        logger.info("No new documents to process.")
+        return 0
+
+    # Fails the run up front if the tokenizer is unavailable
+    get_token_length_function()
+    current_count, processed_pdfs = read_vectorized_manifest()
+    processed_files = 0
+    kept_chunks = 0
+    total_chunks = 0
+    group_size = publish_every or len(blobs)
+    for start in range(0, len(blobs), group_size):
+        # A group's PDFs are only marked as processed once its version is
+        # published, so nothing is removed from pdf/new/ whose chunks could
+        # still be discarded with the version. If another instance published
+        # first, the group is ingested again on top of that.
+        for attempt in range(1, publish_attempts + 1):
+            try:
+                ingested, failed, kept, total = ingest_group(blobs[start:start + group_size])
+                break
+            except PreconditionFailed:
+                if attempt == publish_attempts:
+                    raise
+                logger.warning(f"Another instance published the index first, ingesting the group again (attempt {attempt + 1} of {publish_attempts})")
+        kept_chunks += kept
+        total_chunks += total
+
+        for source in ingested:
+            try:
+                current_count = mark_pdf_processed(source, current_count, processed_pdfs)
+                processed_files += 1
+            except Exception as e:
+                logger.error(f"Error marking {source} as processed: {str(e)}", exc_info=True)
+        for source in failed:
+            try:
+                move_to_failed(source)
+            except Exception as e:
+                logger.error(f"Error moving {source} to {FAILED_PATH}: {str(e)}", exc_info=True)
+
+    if total_chunks:
+        logger.info(f"Deduplication kept {kept_chunks} of {total_chunks} chunks ({1 - kept_chunks / total_chunks:.1%} fewer to embed and store)")
+    logger.info(f"Updated vectorized.txt with {processed_files} new files. Total count: {current_count}")
+    return processed_files
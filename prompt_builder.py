@@ -0,0 +1,135 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+RECENT_TURNS = int(os.getenv("PROMPT_RECENT_TURNS", "6"))
+SUMMARY_FOLD_STEP = int(os.getenv("PROMPT_SUMMARY_FOLD_STEP", "4"))
+SUMMARY_CACHE_SIZE = 1024
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(text: str):
+    # Rough Llama 3 average; only used to keep prompts under a budget
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def _prefix_key(turns):
+    digest = hashlib.sha256()
+    for turn in turns:
+        digest.update(turn["role"].encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(turn["content"].encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class SummaryCache:
+    # Summaries are keyed by a hash of the exact turns they cover and folded in
+    # SUMMARY_FOLD_STEP-turn steps, so each step only summarizes the new turns
+    # on top of the cached summary for an earlier boundary.
+    def __init__(self, max_size: int = SUMMARY_CACHE_SIZE):
+        self.max_size = max_size
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is not None:
+                self._summaries.move_to_end(key)
+            return summary
+
+    def _put(self, key, summary):
+        with self._lock:
+            self._summaries[key] = summary
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.max_size:
+                self._summaries.popitem(last=False)
+
+    def summarize(self, turns, summarize_fn, step: int = SUMMARY_FOLD_STEP):
+        if not turns:
+            return ""
+        key = _prefix_key(turns)
+        summary = self._get(key)
+        if summary is not None:
+            return summary
+        # Resume from the nearest cached boundary; a history loaded without any
+        # cached summary is folded in a single call rather than step by step.
+        start = len(turns) - step
+        previous_summary = None
+        while start > 0 and previous_summary is None:
+            previous_summary = self._get(_prefix_key(turns[:start]))
+            if previous_summary is None:
+                start -= step
+        if previous_summary is None:
+            start, previous_summary = 0, ""
+        summary = summarize_fn(previous_summary, turns[start:])
+        self._put(key, summary)
+        return summary
+
+    def nearest(self, turns, step: int = SUMMARY_FOLD_STEP):
+        # (summary, covered) for the longest step-aligned prefix of turns that
+        # already has a cached summary; never calls the model
+        covered = len(turns)
+        while covered > 0:
+            summary = self._get(_prefix_key(turns[:covered]))
+            if summary is not None:
+                return summary, covered
+            covered -= step
+        return "", 0
+
+summary_cache = SummaryCache()
+
+def trim_context(context: str, max_tokens: int):
+    if estimate_tokens(context) <= max_tokens:
+        return context
+    kept = []
+    used = 0
+    for part in context.split("\n\n"):
+        part_tokens = estimate_tokens(part)
+        if used + part_tokens > max_tokens:
+            break
+        kept.append(part)
+        used += part_tokens
+    if not kept and max_tokens > 0:
+        kept.append(context[:max_tokens * CHARS_PER_TOKEN])
+    return "\n\n".join(kept)
+
+def _turns(chat_history):
+    return [{"role": turn["role"], "content": turn["content"]} for turn in chat_history]
+
+def _fold_boundary(turn_count: int, recent_turns: int, step: int):
+    # Fold on fixed step boundaries so the summary only changes every `step` turns
+    return max(0, (turn_count - recent_turns) // step * step)
+
+def build_prompt_parts(message: str, context: str, chat_history: list, fixed_text: str = "",
+                       token_budget: int = PROMPT_TOKEN_BUDGET, recent_turns: int = RECENT_TURNS, step: int = SUMMARY_FOLD_STEP):
+    # Returns (summary, recent, context) where recent holds the last turns
+    # verbatim, summary covers everything older, and context is trimmed so the
+    # whole prompt stays within token_budget. Only cached summaries are used,
+    # so building a prompt never waits on the model: if the fold for this
+    # boundary is not ready, the nearest earlier one is used and more turns
+    # are kept verbatim (and trimmed to the budget).
+    turns = _turns(chat_history)
+    fold_until = _fold_boundary(len(turns), recent_turns, step)
+    summary, fold_until = summary_cache.nearest(turns[:fold_until], step) if fold_until else ("", 0)
+    recent = turns[fold_until:]
+
+    remaining = token_budget - estimate_tokens(fixed_text) - estimate_tokens(message) - estimate_tokens(summary)
+    while len(recent) > 1 and sum(estimate_tokens(turn["content"]) for turn in recent) > remaining // 2:
+        recent.pop(0)
+    remaining -= sum(estimate_tokens(turn["content"]) for turn in recent)
+
+    return summary, recent, trim_context(context, max(0, remaining))
+
+def fold_summary_ahead(chat_history: list, summarize_fn, recent_turns: int = RECENT_TURNS, step: int = SUMMARY_FOLD_STEP):
+    # Computes the summary the next turn's prompt will need (its history is
+    # this one plus the next question) so the model call happens after a turn
+    # rather than before the next one's first token
+    turns = _turns(chat_history)
+    fold_until = _fold_boundary(len(turns) + 1, recent_turns, step)
+    if fold_until:
+        summary_cache.summarize(turns[:fold_until], summarize_fn, step)
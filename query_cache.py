@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def normalize_query(text: str):
+    return " ".join(text.lower().split())
+
+class QueryEmbeddingCache:
+    # LRU map of normalized query text to its embedding vector. Entries can
+    # optionally expire after ttl_seconds, and the most recent entries can be
+    # persisted to persist_path and reloaded as a warm set on startup.
+    def __init__(self, model_name: str, max_size: int = 1024, ttl_seconds: float | None = None, persist_path: str | None = None):
+        self.model_name = model_name
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        if persist_path:
+            self.load(persist_path)
+
+    def _expired(self, stored_at):
+        return self.ttl_seconds is not None and time.time() - stored_at > self.ttl_seconds
+
+    def get(self, text: str):
+        key = normalize_query(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[1]):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, text: str, vector, stored_at: float | None = None):
+        key = normalize_query(text)
+        with self._lock:
+            self._entries[key] = (list(vector), stored_at or time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def get_or_compute(self, text: str, compute):
+        vector = self.get(text)
+        if vector is None:
+            vector = compute(text)
+            self.put(text, vector)
+        return vector
+
+    def stats(self):
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "size": len(self._entries),
+                "hit_rate": self._hits / total if total else 0.0,
+            }
+
+    def save(self, path: str | None = None):
+        path = path or self.persist_path
+        if not path:
+            return
+        with self._lock:
+            entries = [[key, vector, stored_at] for key, (vector, stored_at) in self._entries.items()]
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"model": self.model_name, "entries": entries}, f)
+        os.replace(temp_path, path)
+        logger.info(f"Saved {len(entries)} query embeddings to {path}")
+
+    def load(self, path: str):
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable query cache {path}: {str(e)}")
+            return
+        if data.get("model") != self.model_name:
+            logger.info(f"Ignoring query cache {path} built for model {data.get('model')}")
+            return
+        for key, vector, stored_at in data.get("entries", [])[-self.max_size:]:
+            if not self._expired(stored_at):
+                self.put(key, vector, stored_at)
+        logger.info(f"Loaded {len(self._entries)} query embeddings from {path}")
@@ -0,0 +1,72 @@
+import os
+import logging
+import threading
+import contextvars
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STAGE_WORKERS = int(os.getenv("TURN_STAGE_WORKERS", "16"))
+
+@lru_cache(maxsize=1)
+def get_stage_executor():
+    return ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="turn-stage")
+
+class TurnStages:
+    # Named stages of one chat turn running on a shared thread pool. A stage
+    # can list other stages it must run after; it is submitted once they have
+    # finished (successfully or not), so no worker blocks waiting on another.
+    # Stage functions must not call Streamlit APIs, which only work on the
+    # script thread. Each stage runs in a copy of the caller's context, so
+    # the turn's trace ID follows it onto the worker thread.
+    def __init__(self, executor=None):
+        self.executor = executor or get_stage_executor()
+        self._futures = {}
+
+    def start(self, name, fn, *args, after=(), **kwargs):
+        future = Future()
+        context = contextvars.copy_context()
+        dependencies = [self._futures[dependency] for dependency in after if dependency in self._futures]
+        remaining = [len(dependencies)]
+        lock = threading.Lock()
+
+        def run():
+            try:
+                result = context.run(fn, *args, **kwargs)
+            except Exception as e:
+                logger.error(f"Error in turn stage {name}: {str(e)}", exc_info=True)
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        def dependency_done(_):
+            with lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                self.executor.submit(run)
+
+        self._futures[name] = future
+        if not dependencies:
+            self.executor.submit(run)
+        for dependency in dependencies:
+            dependency.add_done_callback(dependency_done)
+        return future
+
+    def __contains__(self, name):
+        return name in self._futures
+
+    def result(self, name, timeout=None):
+        return self._futures[name].result(timeout)
+
+    def result_or(self, name, default=None, timeout=None):
+        # For optional stages: the default stands in for a stage that was never
+        # started or failed (the failure is already logged by the stage).
+        if name not in self._futures:
+            return default
+        try:
+            return self._futures[name].result(timeout)
+        except Exception:
+            return default
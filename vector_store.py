@@ -2,44 +2,65 @@ import os
 import logging
 # import tempfile
 import shutil
-from google.cloud import storage
+import atexit
+import threading
+from contextlib import contextmanager
+from gcs_client import get_bucket
 from functools import lru_cache
 from langchain_chroma import Chroma
 from langchain_community.embeddings import FastEmbedEmbeddings
+from concurrent.futures import ThreadPoolExecutor
+from gcs_sync import sync_down, sync_up, publish_snapshot, restore_snapshot, remote_snapshot, remote_manifest_generation, read_snapshot_generation
+from index_versions import writer_lock, current_version_dir, new_version_dir, clone_version, publish_version, discard_version, collect_garbage
+from query_cache import QueryEmbeddingCache
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from metrics import span, timed
+from chunk_dedupe import DuplicateIndex
+from embedding_cache import content_hash, embed_documents
+from compact_index import CompactIndex, build_compact_index
+from embedding_batcher import EmbeddingBatcher
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-BUCKET_NAME = "aiysha-convos"
 CHROMA_PATH = "database/"
-DB_DIR = "chroma_db"
+SNAPSHOT_BLOB = "database-snapshots/chroma_db.tar.gz"
+DEDUPE_LOOKUP_BATCH_SIZE = 500
+EMBEDDING_MODEL = "BAAI/bge-large-en-v1.5"
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "2048"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL_SECONDS", "0")) or None
+QUERY_CACHE_PATH = os.getenv("QUERY_CACHE_PATH")
+EMBED_BATCHING = os.getenv("EMBED_BATCHING", "true").lower() == "true"
+LEXICAL_INDEX_FILE = "bm25_index.json"
+DUPLICATE_INDEX_FILE = "chunk_signatures.json"
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+RRF_K = 60
+# "int8" or "binary" serves dense retrieval from a memory-mapped compact copy
+# of the vectors instead of Chroma's HNSW index; "off" keeps Chroma
+COMPACT_INDEX_MODE = os.getenv("COMPACT_INDEX_MODE", "off")
+COMPACT_INDEX_DIMS = int(os.getenv("COMPACT_INDEX_DIMS", "0")) or None
+COMPACT_INDEX_CANDIDATES = int(os.getenv("COMPACT_INDEX_CANDIDATES", "50"))
+COMPACT_INDEX_RERANK = os.getenv("COMPACT_INDEX_RERANK", "true").lower() == "true"
+COMPACT_INDEX_DIR = "compact"
+# Local-only artifacts, rebuilt from the collection rather than downloaded
+LOCAL_ONLY_DIRS = (COMPACT_INDEX_DIR,)
 # LOCAL_TEMP_DIR = tempfile.mkdtemp()
 
-storage_client = storage.Client()
-bucket = storage_client.bucket(BUCKET_NAME)
+query_embedding_cache = QueryEmbeddingCache(EMBEDDING_MODEL, max_size=QUERY_CACHE_SIZE, ttl_seconds=QUERY_CACHE_TTL, persist_path=QUERY_CACHE_PATH)
+if QUERY_CACHE_PATH:
+    atexit.register(query_embedding_cache.save)
 
-if not os.path.exists(DB_DIR):
-    os.makedirs(DB_DIR)
-
-LOCK_FILE = os.path.join(DB_DIR, "lock")
-
-def acquire_lock():
-    if os.path.exists(LOCK_FILE):
-        logger.warning("Lock file already exists. Waiting for lock to be released.")
-        while os.path.exists(LOCK_FILE):
-            time.sleep(1)
-    with open(LOCK_FILE, "w") as f:
-        f.write("locked")
-
-def release_lock():
-    if os.path.exists(LOCK_FILE):
-        os.remove(LOCK_FILE)
+_embedding_override = None
 
 @lru_cache(maxsize=1)
+@timed("embedding.load")
 def get_embedding_function():
+    if _embedding_override is not None:
+        return _embedding_override
     try:
         logger.debug("Initializing FastEmbedEmbeddings")
-        embedding_function = FastEmbedEmbeddings(model_name="BAAI/bge-large-en-v1.5")
+        embedding_function = FastEmbedEmbeddings(model_name=EMBEDDING_MODEL)
         logger.debug("FastEmbedEmbeddings initialized")
         
         logger.debug("Testing embed_query")
@@ -51,93 +72,436 @@ def get_embedding_function():
         logger.error(f"Error initializing embedding function: {str(e)}", exc_info=True)
         raise
 
-def download_db_from_gcs(local_dir):
-    blobs = bucket.list_blobs(prefix=CHROMA_PATH)
-    for blob in blobs:
-        local_path = os.path.join(local_dir, blob.name[len(CHROMA_PATH):])
-        os.makedirs(os.path.dirname(local_path), exist_ok=True)
-        blob.download_to_filename(local_path)
-    logger.info(f"Downloaded Chroma DB from GCS to {local_dir}")
-
-def upload_db_to_gcs():
-    for root, _, files in os.walk(DB_DIR):
-        for file in files:
-            local_path = os.path.join(root, file)
-            relative_path = os.path.relpath(local_path, DB_DIR)
-            blob = bucket.blob(os.path.join(CHROMA_PATH, relative_path))
-            blob.upload_from_filename(local_path)
-    logger.info(f"Uploaded Chroma DB to GCS from {DB_DIR}")
+def set_embedding_function(embedding_function):
+    # Replaces the FastEmbed model, e.g. with a deterministic fake for offline
+    # benchmarks. Must be called before any store is opened.
+    global _embedding_override
+    _embedding_override = embedding_function
+    get_embedding_function.cache_clear()
+    get_embedding_batcher.cache_clear()
+
+def get_embedding_tokenizer():
+    # The tokenizer FastEmbed loaded with the embedding model, from its local
+    # model cache. Shared with the model, so callers must not reconfigure it.
+    model = getattr(get_embedding_function(), "_model", None)
+    if model is None:
+        raise RuntimeError(f"The embedding function does not carry the {EMBEDDING_MODEL} tokenizer")
+    return model.model.tokenizer
 
 @lru_cache(maxsize=1)
-def get_vector_store():
-    acquire_lock()
-    logger.debug("Entering get_vector_store")
+def get_embedding_batcher():
+    # FastEmbed embeds queries and documents the same way for this model, so
+    # queries can share embed_documents batches
+    return EmbeddingBatcher(get_embedding_function().embed_documents)
+
+def download_db_from_gcs(target_dir, base_dir=None):
+    downloaded = sync_down(CHROMA_PATH, target_dir, base_dir=base_dir)
+    if downloaded is not None:
+        logger.info(f"Downloaded Chroma DB from GCS to {target_dir} ({downloaded} changed files)")
+    return downloaded is not None
+
+@timed("ingest.sync_up")
+def upload_db_to_gcs(version_dir, base_generation):
+    # base_generation is the manifest generation the version was built on (None
+    # if there was none); raises PreconditionFailed if another writer has
+    # published since
+    uploaded, _, manifest_generation = sync_up(version_dir, CHROMA_PATH, exclude=LOCAL_ONLY_DIRS,
+                                               if_generation_match=int(base_generation) if base_generation else 0)
+    logger.info(f"Uploaded Chroma DB to GCS from {version_dir} ({uploaded} changed files)")
+    return manifest_generation
+
+@timed("ingest.publish")
+def publish_db_to_gcs(version_dir, base_generation):
+    # Files first, then the snapshot, once per committed version rather than
+    # once per ingested file. The snapshot records which file sync it matches.
+    manifest_generation = upload_db_to_gcs(version_dir, base_generation)
+    publish_snapshot(version_dir, SNAPSHOT_BLOB, manifest_generation, exclude=LOCAL_ONLY_DIRS)
+
+def restore_db_from_gcs(target_dir, base_dir=None):
+    # Returns True when target_dir was populated with a newer copy than base_dir.
+    # database/ is always synced before the snapshot is taken, so the snapshot
+    # is only used while it matches the current manifest; otherwise (a writer
+    # died in between, or a snapshot from before manifests were recorded) the
+    # files are synced instead.
     try:
-        logger.debug("Getting embedding function")
-        embedding_function = get_embedding_function()
-        logger.debug("Embedding function retrieved")
-
-        logger.debug(f"Checking for Chroma database in GCS at {CHROMA_PATH}chroma.sqlite3")
-        if not bucket.blob(f"{CHROMA_PATH}chroma.sqlite3").exists():
-            logger.warning(f"Chroma database not found in GCS at {CHROMA_PATH}. Creating a new one.")
-            logger.debug(f"Initializing Chroma with persist_directory={DB_DIR}")
-            db = Chroma(persist_directory=DB_DIR, embedding_function=embedding_function)
+        generation, snapshot_manifest = remote_snapshot(SNAPSHOT_BLOB)
+        manifest_generation = remote_manifest_generation(CHROMA_PATH)
+        if generation is not None and snapshot_manifest == manifest_generation:
+            if base_dir and read_snapshot_generation(base_dir) == generation:
+                logger.info(f"Local index already matches snapshot generation {generation}")
+                return False
+            restore_snapshot(SNAPSHOT_BLOB, target_dir, generation)
+            return True
+        if generation is not None:
+            logger.info(f"Snapshot generation {generation} is older than manifest generation {manifest_generation}, syncing files instead")
+    except Exception as e:
+        logger.warning(f"Snapshot restore failed, falling back to file sync: {str(e)}")
+        shutil.rmtree(target_dir, ignore_errors=True)
+
+    if remote_manifest_generation(CHROMA_PATH) is None and not get_bucket().blob(f"{CHROMA_PATH}chroma.sqlite3").exists():
+        return False
+    return download_db_from_gcs(target_dir, base_dir=base_dir)
+
+_stores = {}
+_stores_lock = threading.Lock()
+_index_initialized = False
+
+def open_store(version_dir):
+    logger.debug(f"Initializing Chroma with persist_directory={version_dir}")
+    return Chroma(persist_directory=version_dir, embedding_function=get_embedding_function())
+
+def close_store(db):
+    # chromadb keeps one System (sqlite connections, loaded HNSW segments) per
+    # persist directory for the life of the process, shared by every client
+    # opened on it. Stop and evict it so a dropped version's memory and open
+    # file handles, and with them its disk space, are released.
+    system = db._client._identifer_to_system.pop(db._client._identifier, None)
+    if system is not None:
+        system.stop()
+        logger.info(f"Closed Chroma store at {db._persist_directory}")
+
+def initialize_index():
+    # Brings the local index up to date with GCS once per process. A newer copy
+    # is built as a fresh version and published; the current one is untouched.
+    with writer_lock():
+        base_dir = current_version_dir()
+        target_dir = new_version_dir()
+        # Model load and test embed overlap with the DB fetch instead of preceding it
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            embedding_future = executor.submit(get_embedding_function)
+            restore_future = executor.submit(restore_db_from_gcs, target_dir, base_dir)
+            restored = restore_future.result()
+            embedding_future.result()
+
+        if restored:
+            publish_version(target_dir)
         else:
-            logger.debug("Downloading existing database from GCS")
-            download_db_from_gcs(DB_DIR)
-            logger.debug(f"Initializing Chroma with persist_directory={DB_DIR}")
-            db = Chroma(persist_directory=DB_DIR, embedding_function=embedding_function)
-            
-        db_file_path = os.path.join(DB_DIR, "chroma.sqlite3")
-        if not os.path.exists(db_file_path):
-            logger.error(f"Database file not found at {db_file_path}")
-            raise FileNotFoundError(f"Database file not found at {db_file_path}")
-        
-        logger.debug("Vector store initialized successfully")
+            if os.path.exists(target_dir):
+                discard_version(target_dir)
+            if base_dir is None:
+                logger.warning(f"Chroma database not found in GCS at {CHROMA_PATH}. Creating a new one.")
+                publish_version(clone_version(None, target_dir))
+        collect_garbage()
+
+@timed("vector_store.get")
+def get_vector_store():
+    # Returns the store for the published version. Callers should hold on to
+    # the returned object for the duration of a request; a version published
+    # meanwhile is picked up by the next call without disturbing this one.
+    global _index_initialized
+    version_dir = current_version_dir()
+    db = _stores.get(version_dir)
+    if db is not None and _index_initialized:
         return db
+
+    logger.debug("Entering get_vector_store")
+    try:
+        with _stores_lock:
+            if not _index_initialized:
+                initialize_index()
+                _index_initialized = True
+            version_dir = current_version_dir()
+            if version_dir not in _stores:
+                _stores[version_dir] = open_store(version_dir)
+                db_file_path = os.path.join(version_dir, "chroma.sqlite3")
+                if not os.path.exists(db_file_path):
+                    logger.error(f"Database file not found at {db_file_path}")
+                    raise FileNotFoundError(f"Database file not found at {db_file_path}")
+                if COMPACT_INDEX_MODE != "off":
+                    # Built here, once per version, rather than in the first query
+                    try:
+                        get_compact_index(_stores[version_dir])
+                    except Exception as e:
+                        logger.warning(f"Could not build the compact index for {version_dir}: {str(e)}")
+                # Only the two newest versions stay open; older ones become collectable
+                for stale_dir in sorted(_stores)[:-2]:
+                    close_store(_stores.pop(stale_dir))
+            logger.debug("Vector store initialized successfully")
+            return _stores[version_dir]
     except Exception as e:
         logger.error(f"Error in get_vector_store: {str(e)}", exc_info=True)
         return None
-    finally:
-        release_lock()
 
-def add_to_chroma(chunks):
-    db = get_vector_store()
-    existing_items = db.get(include=[])
-    existing_ids = set(existing_items["ids"])
-    logger.info(f"{len(existing_ids)} documents exist in vector store.")
+class IndexWriter:
+    def __init__(self, version_dir, db):
+        self.version_dir = version_dir
+        self.db = db
+        self.changed = False
+
+    def mark_changed(self):
+        # The compact index is a snapshot of the collection, copied in from the
+        # previous version; drop it so it is rebuilt for the new contents
+        shutil.rmtree(os.path.join(self.version_dir, COMPACT_INDEX_DIR), ignore_errors=True)
+        self.changed = True
+
+@contextmanager
+def open_index_writer():
+    # Builds the next version on a private copy of the published one under the
+    # cross-process writer lock. The copy is published only if the block
+    # completes and changed something; otherwise it is thrown away, so a crash
+    # mid-ingestion never touches the serving index. Changes are committed
+    # locally as they are written and reach GCS once, when the block ends; the
+    # lexical and duplicate indexes are kept in memory until then and saved
+    # once per version.
+    # The writer lock only covers this disk. Other instances publish to GCS as
+    # well, so the copy starts from the latest version there and is committed
+    # only if nobody published since; otherwise the block's changes are thrown
+    # away and PreconditionFailed is raised for the caller to redo them.
+    if get_vector_store() is None:
+        raise RuntimeError("Vector store is not available")
+    with writer_lock():
+        base_generation = remote_manifest_generation(CHROMA_PATH)
+        base_dir = current_version_dir()
+        refreshed_dir = new_version_dir()
+        if restore_db_from_gcs(refreshed_dir, base_dir):
+            publish_version(refreshed_dir)
+            base_dir = refreshed_dir
+        version_dir = clone_version(base_dir, new_version_dir())
+        writer = IndexWriter(version_dir, open_store(version_dir))
+        try:
+            yield writer
+            if writer.changed:
+                get_lexical_index(writer.db).save(os.path.join(version_dir, LEXICAL_INDEX_FILE))
+                get_duplicate_index(writer.db).save(os.path.join(version_dir, DUPLICATE_INDEX_FILE))
+                publish_db_to_gcs(version_dir, base_generation)
+        except BaseException:
+            close_store(writer.db)
+            discard_version(version_dir)
+            raise
+        if writer.changed:
+            # Readers opening the published version share the writer's Chroma
+            # system, which is closed when the version leaves _stores
+            publish_version(version_dir)
+        else:
+            close_store(writer.db)
+            discard_version(version_dir)
+        with _stores_lock:
+            collect_garbage(in_use=list(_stores))
+
+_lexical_indexes = {}
+_lexical_index_lock = threading.Lock()
+
+def get_lexical_index(db):
+    # One BM25 index per version directory, stored next to that version's DB
+    version_dir = db._persist_directory
+    lexical_index = _lexical_indexes.get(version_dir)
+    if lexical_index is None:
+        with _lexical_index_lock:
+            lexical_index = _lexical_indexes.get(version_dir)
+            if lexical_index is None:
+                index_path = os.path.join(version_dir, LEXICAL_INDEX_FILE)
+                if os.path.exists(index_path):
+                    lexical_index = BM25Index.load(index_path)
+                    logger.info(f"Loaded lexical index with {len(lexical_index)} documents")
+                else:
+                    # One-off backfill for collections created before the lexical index
+                    lexical_index = BM25Index()
+                    existing_items = db.get(include=["documents"])
+                    if existing_items["ids"]:
+                        lexical_index.add(existing_items["ids"], existing_items["documents"])
+                        lexical_index.save(index_path)
+                        logger.info(f"Built lexical index from {len(lexical_index)} existing documents")
+                for stale_dir in [path for path in _lexical_indexes if not os.path.isdir(path)]:
+                    del _lexical_indexes[stale_dir]
+                _lexical_indexes[version_dir] = lexical_index
+    return lexical_index
+
+_duplicate_indexes = {}
+_duplicate_index_lock = threading.Lock()
+
+def get_duplicate_index(db):
+    # Chunk signatures for near-duplicate filtering, one per version directory
+    version_dir = db._persist_directory
+    duplicate_index = _duplicate_indexes.get(version_dir)
+    if duplicate_index is None:
+        with _duplicate_index_lock:
+            duplicate_index = _duplicate_indexes.get(version_dir)
+            if duplicate_index is None:
+                index_path = os.path.join(version_dir, DUPLICATE_INDEX_FILE)
+                if os.path.exists(index_path):
+                    duplicate_index = DuplicateIndex.load(index_path)
+                else:
+                    # One-off backfill for collections created before deduplication
+                    duplicate_index = DuplicateIndex()
+                    existing_items = db.get(include=["documents"])
+                    if existing_items["ids"]:
+                        duplicate_index.add(existing_items["ids"], existing_items["documents"])
+                        duplicate_index.save(index_path)
+                        logger.info(f"Built duplicate index from {len(duplicate_index)} existing documents")
+                for stale_dir in [path for path in _duplicate_indexes if not os.path.isdir(path)]:
+                    del _duplicate_indexes[stale_dir]
+                _duplicate_indexes[version_dir] = duplicate_index
+    return duplicate_index
+
+_compact_indexes = {}
+_compact_index_lock = threading.Lock()
+
+def build_version_compact_index(version_dir, db, mode: str = COMPACT_INDEX_MODE, dims: int | None = COMPACT_INDEX_DIMS, rerank: bool = COMPACT_INDEX_RERANK):
+    return build_compact_index(db, os.path.join(version_dir, COMPACT_INDEX_DIR), mode=mode, dims=dims, rerank=rerank)
+
+def get_compact_index(db):
+    # The compact index of db's version directory, built on first use: it is
+    # not shipped through GCS, and one left over from other contents of the
+    # collection is rebuilt. None when compact mode is off or the store is empty.
+    if COMPACT_INDEX_MODE == "off":
+        return None
+    version_dir = db._persist_directory
+    compact_index = _compact_indexes.get(version_dir)
+    if compact_index is None:
+        with _compact_index_lock:
+            compact_index = _compact_indexes.get(version_dir)
+            if compact_index is None:
+                index_dir = os.path.join(version_dir, COMPACT_INDEX_DIR)
+                compact_index = CompactIndex(index_dir) if os.path.exists(os.path.join(index_dir, "meta.json")) else None
+                if compact_index is None or len(compact_index) != db._collection.count():
+                    if build_version_compact_index(version_dir, db) is None:
+                        return None
+                    compact_index = CompactIndex(index_dir)
+                logger.info(f"Loaded {compact_index.mode} compact index with {len(compact_index)} vectors ({compact_index.nbytes() / 2**20:.1f} MiB mapped)")
+                for stale_dir in [path for path in _compact_indexes if not os.path.isdir(path)]:
+                    del _compact_indexes[stale_dir]
+                _compact_indexes[version_dir] = compact_index
+    return compact_index
 
-    new_chunks = [chunk for chunk in chunks if chunk.metadata["id"] not in existing_ids]
+def find_existing_hashes(db, ids, lookup_batch_size: int = DEDUPE_LOOKUP_BATCH_SIZE):
+    # content_hash of each stored chunk among ids; computed from the stored
+    # text for chunks written before the hash was recorded. Looks up only the
+    # candidate IDs (primary-key lookups in Chroma's sqlite), so the cost
+    # tracks the size of the ingestion, not of the collection.
+    existing_hashes = {}
+    for i in range(0, len(ids), lookup_batch_size):
+        existing_items = db.get(ids=ids[i:i+lookup_batch_size], include=["metadatas", "documents"])
+        for doc_id, metadata, document in zip(existing_items["ids"], existing_items["metadatas"], existing_items["documents"]):
+            existing_hashes[doc_id] = (metadata or {}).get("content_hash") or content_hash(document)
+    return existing_hashes
 
-    if new_chunks:
-        logger.info(f"Adding {len(new_chunks)} new documents to the vector store.")
-        max_batch_size = 5000
-        batches = [new_chunks[i:i+max_batch_size] for i in range(0, len(new_chunks), max_batch_size)]
+def find_stored_embeddings(db, hashes, lookup_batch_size: int = DEDUPE_LOOKUP_BATCH_SIZE):
+    # Vectors already in the store for any of the given content hashes. They
+    # travel with the index through GCS, so text embedded before (under any
+    # chunk ID or file name) is reused by every instance, including fresh ones.
+    stored = {}
+    hashes = list(dict.fromkeys(hashes))
+    for i in range(0, len(hashes), lookup_batch_size):
+        items = db._collection.get(where={"content_hash": {"$in": hashes[i:i+lookup_batch_size]}}, include=["metadatas", "embeddings"])
+        for metadata, embedding in zip(items["metadatas"], items["embeddings"]):
+            stored.setdefault(metadata["content_hash"], embedding.tolist() if hasattr(embedding, "tolist") else embedding)
+    return stored
+
+def find_stale_ids(db, sources, chunks):
+    # IDs stored for the sources that the new chunks no longer cover, e.g.
+    # pages dropped from a revised PDF
+    kept_ids = {chunk.metadata["id"] for chunk in chunks}
+    stale_ids = []
+    for source in sources:
+        stored_ids = db.get(where={"source": source}, include=[])["ids"]
+        stale_ids.extend(doc_id for doc_id in stored_ids if doc_id not in kept_ids)
+    return stale_ids
+
+def add_to_chroma(chunks, batch_size: int = 5000, writer: IndexWriter | None = None, replace_sources=()):
+    # Writes chunks whose ID is new or whose text changed, embedding only text
+    # the store does not already hold a vector for. For each source in replace_sources,
+    # chunks holds its complete new content and its other stored chunks are
+    # deleted.
+    if writer is None:
+        with open_index_writer() as writer:
+            return add_to_chroma(chunks, batch_size, writer, replace_sources)
+
+    db = writer.db
+    for chunk in chunks:
+        chunk.metadata["content_hash"] = content_hash(chunk.page_content)
+    candidate_ids = list(dict.fromkeys(chunk.metadata["id"] for chunk in chunks))
+    with span("ingest.dedupe"):
+        existing_hashes = find_existing_hashes(db, candidate_ids)
+        stale_ids = find_stale_ids(db, replace_sources, chunks)
+
+    changed_chunks = [chunk for chunk in chunks if existing_hashes.get(chunk.metadata["id"]) != chunk.metadata["content_hash"]]
+    updated_count = sum(1 for chunk in changed_chunks if chunk.metadata["id"] in existing_hashes)
+    logger.info(f"{len(candidate_ids) - len(changed_chunks)} of {len(candidate_ids)} candidate documents are unchanged in vector store; "
+                f"{len(changed_chunks) - updated_count} new, {updated_count} changed, {len(stale_ids)} stale.")
+
+    if changed_chunks or stale_ids:
+        lexical_index = get_lexical_index(db)
+        duplicate_index = get_duplicate_index(db)
+        # Looked up before stale chunks are deleted, so text that only moved to
+        # another ID (e.g. a page inserted earlier in a revised PDF) is reused
+        with span("ingest.stored_vectors"):
+            stored_embeddings = find_stored_embeddings(db, [chunk.metadata["content_hash"] for chunk in changed_chunks])
+        if stale_ids:
+            db.delete(ids=stale_ids)
+            lexical_index.remove(stale_ids)
+            duplicate_index.remove(stale_ids)
+        reused_count = 0
+        batches = [changed_chunks[i:i+batch_size] for i in range(0, len(changed_chunks), batch_size)]
         for batch in batches:
             batch_ids = [chunk.metadata["id"] for chunk in batch]
-            db.add_documents(batch, ids=batch_ids)
-        # new_chunk_ids = [chunk.metadata["id"] for chunk in new_chunks]
-        # db.add_documents(new_chunks, ids=new_chunk_ids)
-        upload_db_to_gcs()
+            batch_texts = [chunk.page_content for chunk in batch]
+            with span("ingest.embed"):
+                vectors, reused = embed_documents(batch_texts, stored_embeddings, get_embedding_function().embed_documents)
+            reused_count += reused
+            with span("ingest.write"):
+                db._collection.upsert(ids=batch_ids, embeddings=vectors, documents=batch_texts, metadatas=[chunk.metadata for chunk in batch])
+            lexical_index.add(batch_ids, batch_texts)
+            duplicate_index.add(batch_ids, batch_texts)
+        logger.info(f"Reused {reused_count} stored vectors, embedded {len(changed_chunks) - reused_count} chunks")
+        writer.mark_changed()
     else:
         logging.info("No new documents to add to the vector store.")
 
-def query_vector_store(query: str, db, k: int = 3):
+def embed_query(query: str):
+    def compute(text):
+        with span("embedding.query"):
+            if EMBED_BATCHING:
+                return get_embedding_batcher().embed(text)
+            return get_embedding_function().embed_query(text)
+    return query_embedding_cache.get_or_compute(query, compute)
+
+def dense_ranking(query: str, db, k: int, compact: bool = False):
+    # [(doc_id, text)] best first, from the compact index when requested and built
+    query_embedding = embed_query(query)
+    compact_index = get_compact_index(db) if compact else None
+    if compact_index is not None:
+        lexical_index = get_lexical_index(db)
+        results = compact_index.search(query_embedding, k=k, candidates=max(COMPACT_INDEX_CANDIDATES, k))
+        texts = ((doc_id, lexical_index.get_text(doc_id)) for doc_id, score in results)
+        return [(doc_id, text) for doc_id, text in texts if text is not None]
+    results = db.similarity_search_by_vector_with_relevance_scores(query_embedding, k=k)
+    return [(doc.metadata.get("id", doc.page_content), doc.page_content) for doc, score in results]
+
+def dense_search(query: str, db, k: int = 3, compact: bool = False):
+    return [text for doc_id, text in dense_ranking(query, db, k, compact)]
+
+def hybrid_search(query: str, db, k: int = 3, candidates: int = HYBRID_CANDIDATES, compact: bool = False):
+    texts = {}
+    dense_ids = []
+    for doc_id, text in dense_ranking(query, db, candidates, compact):
+        texts[doc_id] = text
+        dense_ids.append(doc_id)
+
+    lexical_index = get_lexical_index(db)
+    lexical_ranking = [doc_id for doc_id, score in lexical_index.search(query, k=candidates)]
+    for doc_id in lexical_ranking:
+        texts.setdefault(doc_id, lexical_index.get_text(doc_id))
+
+    fused = reciprocal_rank_fusion([dense_ids, lexical_ranking], k=RRF_K)
+    return [texts[doc_id] for doc_id in fused[:k]]
+
+@timed("retrieval")
+def query_vector_store(query: str, db, k: int = 3, hybrid: bool = HYBRID_SEARCH, compact: bool = COMPACT_INDEX_MODE != "off"):
     # logger.info(f"Number of documents in the vector store: {db._collection.count()}")
     try:
-        results = db.similarity_search_with_score(query, k=k)
+        results = hybrid_search(query, db, k=k, compact=compact) if hybrid else dense_search(query, db, k=k, compact=compact)
         if not results:
             logger.warning("No results found for the given query.")
             return ""
         # logger.info(f"SIMILARITY SEARCH RESULTS: {results}")
-        context = "\n\n".join([doc.page_content for doc, score in results])
+        context = "\n\n".join(results)
         return context
     except Exception as e:
         logger.error(f"Error in query_vector_store: {str(e)}")
         raise
 
 def clear_database():
-    blobs = bucket.list_blobs(prefix=CHROMA_PATH)
+    blobs = get_bucket().list_blobs(prefix=CHROMA_PATH)
     for blob in blobs:
         blob.delete()
     logger.info(f"Cleared database in GCS at {CHROMA_PATH}")
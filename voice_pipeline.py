@@ -0,0 +1,166 @@
+import io
+import os
+import re
+import time
+import wave
+import logging
+import contextvars
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from audio_processor import text_to_speech
+from http_client import get_http_client
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TTS_MAX_PARALLEL = int(os.getenv("TTS_MAX_PARALLEL", "3"))
+MIN_SENTENCE_CHARS = int(os.getenv("TTS_MIN_SENTENCE_CHARS", "20"))
+SENTENCE_END = re.compile(r"(?<=[.!?…])[\"')\]]*\s+")
+
+@dataclass
+class Clip:
+    text: str
+    url: str | None = None
+    data: bytes | None = None
+    duration: float = 0.0
+
+def wav_duration(data: bytes):
+    with wave.open(io.BytesIO(data)) as wav:
+        return wav.getnframes() / float(wav.getframerate())
+
+def combine_wavs(clips):
+    # Concatenates the clips' frames under the first clip's format; clips in a
+    # different format are left out rather than corrupting the result.
+    clips = [clip for clip in clips if clip.data]
+    if not clips:
+        return None
+    output = io.BytesIO()
+    with wave.open(io.BytesIO(clips[0].data)) as first:
+        params = first.getparams()
+    with wave.open(output, "wb") as combined:
+        combined.setparams(params)
+        for clip in clips:
+            with wave.open(io.BytesIO(clip.data)) as wav:
+                if wav.getparams()[:3] != params[:3]:
+                    logger.warning(f"Skipping clip with mismatched WAV format: {clip.url}")
+                    continue
+                combined.writeframes(wav.readframes(wav.getnframes()))
+    return output.getvalue()
+
+class SentenceSplitter:
+    # Turns a stream of text deltas into sentences. Very short sentences are
+    # held back and merged with the next one so each TTS request carries a
+    # useful amount of speech.
+    def __init__(self, min_chars: int = MIN_SENTENCE_CHARS):
+        self.min_chars = min_chars
+        self._buffer = ""
+
+    def feed(self, delta: str):
+        self._buffer += delta
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(self._buffer):
+            if match.end() - start >= self.min_chars:
+                sentences.append(self._buffer[start:match.end()].strip())
+                start = match.end()
+        self._buffer = self._buffer[start:]
+        return sentences
+
+    def flush(self):
+        remainder, self._buffer = self._buffer.strip(), ""
+        return [remainder] if remainder else []
+
+class SpeechSynthesizer:
+    # Synthesizes sentences with at most max_parallel TTS requests in flight
+    # and hands the clips back strictly in sentence order.
+    def __init__(self, synthesize=text_to_speech, max_parallel: int = TTS_MAX_PARALLEL):
+        self.synthesize = synthesize
+        self._executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="tts")
+        self._futures = []
+        self._next = 0
+        self._closed = False
+        self.clips = []
+
+    def _render(self, sentence):
+        clip = Clip(text=sentence)
+        clip.url = self.synthesize(sentence)
+        if clip.url:
+            response = get_http_client().get(clip.url)
+            response.raise_for_status()
+            clip.data = response.content
+            clip.duration = wav_duration(clip.data)
+        return clip
+
+    def submit(self, sentence: str):
+        self._futures.append(self._executor.submit(contextvars.copy_context().run, self._render, sentence))
+
+    def close(self):
+        self._closed = True
+        self._executor.shutdown(wait=False)
+
+    @property
+    def finished(self):
+        return self._closed and self._next >= len(self._futures)
+
+    def next_clip(self, block: bool = False):
+        # The next clip in order, or None if it is not ready (or none is queued yet)
+        if self._next >= len(self._futures):
+            return None
+        future = self._futures[self._next]
+        if not block and not future.done():
+            return None
+        self._next += 1
+        try:
+            clip = future.result()
+        except Exception as e:
+            logger.error(f"Error in TTS request: {str(e)}")
+            clip = Clip(text="")
+        self.clips.append(clip)
+        return clip
+
+    def synthesized_clips(self):
+        # Every submitted clip in sentence order, waiting for synthesis but not
+        # for playback; failures were logged when playback reached them
+        clips = []
+        for future in self._futures:
+            try:
+                clips.append(future.result())
+            except Exception:
+                clips.append(Clip(text=""))
+        return clips
+
+    def combined_audio(self):
+        # Call after close(); safe to run on another thread while playback drains
+        return combine_wavs(self.synthesized_clips())
+
+class VoicePlayback:
+    # Paces clips into a single player: the next clip is handed to play only
+    # once the previous one has had time to finish.
+    def __init__(self, synthesizer: SpeechSynthesizer, play):
+        self.synthesizer = synthesizer
+        self.play = play
+        self._ends_at = 0.0
+        self.first_audio_at = None
+
+    def _play(self, clip):
+        if not clip.data:
+            return
+        self.play(clip)
+        now = time.monotonic()
+        self.first_audio_at = self.first_audio_at or now
+        self._ends_at = now + clip.duration
+
+    def poll(self):
+        if time.monotonic() >= self._ends_at:
+            clip = self.synthesizer.next_clip()
+            if clip is not None:
+                self._play(clip)
+
+    def drain(self):
+        while not self.synthesizer.finished:
+            time.sleep(max(0.0, self._ends_at - time.monotonic()))
+            clip = self.synthesizer.next_clip(block=True)
+            if clip is None:
+                break
+            self._play(clip)
+        time.sleep(max(0.0, self._ends_at - time.monotonic()))